@@ -1,20 +1,69 @@
 import math
+import random
+from collections import defaultdict
+import numpy as np
+import routeloader
+from routestore import EdgeIndex
+from tracing import traced
+
+
+class ColonyState:
+    # Colony of a single vehicle, kept between simulation steps so that the
+    # search can be refined instead of restarted. best_path is kept as int32
+    # array of node indices (see CAMOACO.nodes)
+    def __init__(self, pheromone, best_path, best_cost, metrics):
+        self.pheromone = pheromone
+        self.best_path = best_path
+        self.best_cost = best_cost
+        self.metrics = metrics  # (distance, travel time, congestion) per hop of best_path, shape (hops, 3)
+        self.cost_change = 0.0  # relative change of the path cost at the last metric refresh
+
 
 class CAMOACO:
-    def __init__(self, num_ants, alpha, beta, rho, q0, max_iterations):
+    def __init__(self, num_ants, alpha, beta, rho, q0, max_iterations,
+                 refine_iterations=3, metric_tolerance=0.05, min_pheromone=0.1, max_pheromone=5.0):
         self.num_ants = num_ants
         self.alpha = alpha
         self.beta = beta
         self.rho = rho
         self.q0 = q0
         self.max_iterations = max_iterations
-        self.pheromone = {}
+        self.pheromone = defaultdict(lambda: 1.0)
         self.heuristic = {}
 
+        # Pheromone every colony starts from, seeded by warm_start() and
+        # bounded by min_pheromone and max_pheromone
+        self.initial_pheromone = {}
+        self.min_pheromone = min_pheromone
+        self.max_pheromone = max_pheromone
+
+        # Incremental re-optimization: per-vehicle colony states, the number of
+        # iterations spent when the metrics of a kept path have changed and the
+        # relative change of a hop metric that counts as a change
+        self.refine_iterations = refine_iterations
+        self.metric_tolerance = metric_tolerance
+        self.colonies = {}
+        # Numbers the nodes of the kept paths, node ids are only restored for
+        # the path handed back to the caller
+        self.nodes = EdgeIndex()
+
     def initialize_pheromone(self, edges):
         for edge in edges:
             self.pheromone[edge] = 1.0
 
+    def warm_start(self, alternatives_file):
+        # Seed the trails along the routes of a duarouter alternatives file,
+        # whose nodes are edges: each transition gets pheromone in proportion
+        # to probability / cost of the routes using it
+        deposits = routeloader.transition_deposits(alternatives_file, self.nodes)
+        pairs = list(deposits)
+        levels = routeloader.pheromone_levels([deposits[pair] for pair in pairs], 1.0,
+                                              self.min_pheromone, self.max_pheromone)
+        ids = self.nodes.ids
+        self.initial_pheromone = dict([((ids[a], ids[b]), level) for (a, b), level in zip(pairs, levels.tolist())])
+        self.pheromone = defaultdict(lambda: 1.0, self.initial_pheromone)
+        return len(self.initial_pheromone)
+
     def calculate_transition_probability(self, current_node, next_node):
         # Calculate the heuristic value based on distance, travel time, and congestion
         distance = self.get_distance(current_node, next_node)
@@ -27,6 +76,7 @@ class CAMOACO:
         probability = (pheromone_value ** self.alpha) * (heuristic ** self.beta)
         return probability
 
+    @traced("CAMOACO.update_pheromone", "aco")
     def update_pheromone(self, path, path_cost):
         for i in range(len(path) - 1):
             current_node = path[i]
@@ -44,11 +94,128 @@ class CAMOACO:
                 probabilities.append(probability)
                 next_nodes.append(neighbor)
 
+        if not next_nodes:
+            return None  # dead end
+
         if random.random() < self.q0:
             return next_nodes[probabilities.index(max(probabilities))]
         else:
             return random.choices(next_nodes, weights=probabilities, k=1)[0]
 
+    def construct_path(self, start_node, end_node):
+        path = [start_node]
+        current_node = start_node
+
+        while current_node != end_node:
+            next_node = self.select_next_node(current_node, path)
+            if next_node is None:
+                return None
+            path.append(next_node)
+            current_node = next_node
+
+        return path
+
+    @traced("CAMOACO.run", "aco")
+    def run(self, start_node, end_node):
+        self.pheromone = defaultdict(lambda: 1.0, self.initial_pheromone)
+        return self.search(start_node, end_node, self.max_iterations)
+
+    @traced("CAMOACO.search", "aco")
+    def search(self, start_node, end_node, iterations, best_path=None, best_cost=float('inf')):
+        # Let the ants walk on the current pheromone trails, starting from the
+        # given best path (if any)
+        for _ in range(iterations):
+            for _ in range(self.num_ants):
+                path = self.construct_path(start_node, end_node)
+                if path is None:
+                    continue
+
+                path_cost = self.calculate_path_cost(path)
+                if path_cost < best_cost:
+                    best_path = path
+                    best_cost = path_cost
+
+                self.update_pheromone(path, path_cost)
+
+        return best_path, best_cost
+
+    @traced("CAMOACO.reoptimize", "aco")
+    def reoptimize(self, vehicle_id, current_node, end_node):
+        # Incremental version of run(): the colony of each vehicle survives
+        # between calls. As long as the vehicle follows its best path, the path
+        # is trimmed to the current node and the ants only walk again when the
+        # metrics along the remaining path have changed.
+        state = self.colonies.get(vehicle_id)
+        current = self.nodes.index.get(current_node)
+        offset = self.path_offset(state, current)
+        if offset is None or state.best_path[-1] != self.nodes.index.get(end_node):
+            best_path, best_cost = self.run(current_node, end_node)
+            self.colonies[vehicle_id] = ColonyState(
+                self.pheromone, self.nodes.encode(best_path) if best_path else None, best_cost,
+                self.path_metrics(best_path) if best_path else None)
+            return best_path, best_cost
+
+        # Drop the part of the path that has already been driven
+        path = self.nodes.decode(state.best_path[offset:])
+        old_metrics = state.metrics[offset:]
+        metrics = self.path_metrics(path)
+        cost = float(metrics.sum())
+        old_cost = float(old_metrics.sum())
+        state.cost_change = abs(cost - old_cost) / max(old_cost, 1.0)
+
+        if self.metrics_changed(old_metrics, metrics):
+            self.pheromone = state.pheromone
+            path, cost = self.search(current_node, end_node, self.refine_iterations, path, cost)
+            metrics = self.path_metrics(path)
+
+        state.best_path = self.nodes.encode(path)
+        state.best_cost = cost
+        state.metrics = metrics
+        return path, cost
+
+    def cost_change(self, vehicle_id, current_node):
+        # Relative change in the cost of the kept path since it was chosen
+        state = self.colonies.get(vehicle_id)
+        offset = self.path_offset(state, self.nodes.index.get(current_node))
+        if offset is None:
+            return 1.0
+        old_cost = float(state.metrics[offset:].sum())
+        cost = self.calculate_path_cost(self.nodes.decode(state.best_path[offset:]))
+        return abs(cost - old_cost) / max(old_cost, 1.0)
+
+    def estimated_cost_change(self, vehicle_id, current_node):
+        # Cheap stand-in for cost_change() to rank vehicles by: the change seen
+        # at the last refresh of the kept path, without evaluating the metrics
+        state = self.colonies.get(vehicle_id)
+        if self.path_offset(state, self.nodes.index.get(current_node)) is None:
+            return 1.0
+        return state.cost_change
+
+    def path_offset(self, state, current):
+        # Position of the node index current on the kept path, None if the
+        # vehicle has left it
+        if state is None or state.best_path is None or current is None:
+            return None
+        hits = np.flatnonzero(state.best_path == current)
+        return int(hits[0]) if len(hits) else None
+
+    def forget(self, vehicle_id):
+        # Drop the colony of a vehicle which has left the simulation
+        self.colonies.pop(vehicle_id, None)
+
+    def path_metrics(self, path):
+        return np.array([(self.get_distance(current_node, next_node),
+                          self.get_travel_time(current_node, next_node),
+                          self.get_congestion(next_node))
+                         for current_node, next_node in zip(path[:-1], path[1:])],
+                        dtype=np.float64).reshape(-1, 3)
+
+    def metrics_changed(self, old_metrics, metrics):
+        hops = min(len(old_metrics), len(metrics))
+        old_metrics, metrics = old_metrics[:hops], metrics[:hops]
+        tolerance = self.metric_tolerance * np.maximum(np.abs(old_metrics), 1.0)
+        return bool(np.any(np.abs(metrics - old_metrics) > tolerance))
+
     def calculate_path_cost(self, path):
         total_distance = 0
         total_travel_time = 0
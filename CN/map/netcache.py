@@ -0,0 +1,365 @@
+"""
+Compiled binary cache of a SUMO network.
+
+Parsing the XML of a network with sumolib dominates the startup of the
+tools in this directory. The cache stores edges, nodes, connections,
+lengths, speeds, permissions and coordinates as flat arrays in one binary
+file next to the network, keyed by the SHA-1 of the XML. Loading maps the
+arrays into memory and builds lightweight objects which offer the part of
+the sumolib.net API used by randomTrips.py and acoTrips.py. The cache is
+rebuilt automatically whenever the XML changes.
+
+File layout: MAGIC, the length of the JSON header (8 bytes little endian),
+the JSON header and the arrays, each aligned to 8 bytes.
+"""
+
+from __future__ import print_function
+from __future__ import absolute_import
+import os
+import sys
+import json
+import math
+import mmap
+import struct
+import hashlib
+
+import numpy as np
+
+if 'SUMO_HOME' in os.environ:
+    sys.path.append(os.path.join(os.environ['SUMO_HOME'], 'tools'))
+import sumolib  # noqa
+
+MAGIC = b"NETCACHE1\n"
+CACHE_SUFFIX = ".cache"
+FRINGE_INCOMING = 1
+FRINGE_OUTGOING = 2
+TURN_DIRECTIONS = ("t", "T")
+
+
+def file_digest(fname):
+    digest = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _is_fringe(connections):
+    # same criterion as sumolib.net.edge.Edge.is_fringe
+    return all([c._direction in TURN_DIRECTIONS for conns in connections.values() for c in conns])
+
+
+def compile_net(net, digest, cachefile):
+    """writes the cache for the given sumolib net"""
+    edges = net.getEdges()
+    nodes = net.getNodes()
+    edge_index = dict([(e, i) for i, e in enumerate(edges)])
+    node_index = dict([(n, i) for i, n in enumerate(nodes)])
+
+    vclasses = set()
+    for edge in edges:
+        for lane in edge.getLanes():
+            vclasses.update(lane._allowed)
+        for conns in edge.getOutgoing().values():
+            for conn in conns:
+                vclasses.update(conn._allowed)
+    vclasses = sorted(vclasses)
+    if len(vclasses) > 64:
+        raise ValueError("too many vehicle classes for the permission bit masks")
+    vclass_bit = dict([(v, 1 << i) for i, v in enumerate(vclasses)])
+
+    def mask(allowed):
+        result = 0
+        for vclass in allowed:
+            result |= vclass_bit[vclass]
+        return result
+
+    types = sorted(set([e.getType() for e in edges]))
+    type_index = dict([(t, i) for i, t in enumerate(types)])
+    conn_from = []
+    conn_to = []
+    conn_permissions = []
+    for edge in edges:
+        for to_edge, conns in edge.getOutgoing().items():
+            conn_from.append(edge_index[edge])
+            conn_to.append(edge_index[to_edge])
+            permissions = 0
+            for conn in conns:
+                permissions |= (mask(conn.getFromLane()._allowed) & mask(conn.getToLane()._allowed) &
+                                mask(conn._allowed))
+            conn_permissions.append(permissions)
+
+    arrays = [
+        ("edge_from", np.array([node_index[e.getFromNode()] for e in edges], dtype=np.int32)),
+        ("edge_to", np.array([node_index[e.getToNode()] for e in edges], dtype=np.int32)),
+        ("edge_length", np.array([e.getLength() for e in edges], dtype=np.float64)),
+        ("edge_speed", np.array([e.getSpeed() for e in edges], dtype=np.float64)),
+        ("edge_lanes", np.array([e.getLaneNumber() for e in edges], dtype=np.int32)),
+        ("edge_type", np.array([type_index[e.getType()] for e in edges], dtype=np.int32)),
+        ("edge_permissions", np.array([mask(set().union(*[l._allowed for l in e.getLanes()]))
+                                       for e in edges], dtype=np.uint64)),
+        ("edge_fringe", np.array([(FRINGE_INCOMING if _is_fringe(e._incoming) else 0) |
+                                  (FRINGE_OUTGOING if _is_fringe(e._outgoing) else 0)
+                                  for e in edges], dtype=np.uint8)),
+        ("edge_bbox", np.array([e.getBoundingBox() for e in edges], dtype=np.float64).reshape(-1, 4)),
+        ("node_x", np.array([n.getCoord()[0] for n in nodes], dtype=np.float64)),
+        ("node_y", np.array([n.getCoord()[1] for n in nodes], dtype=np.float64)),
+        ("conn_from", np.array(conn_from, dtype=np.int32)),
+        ("conn_to", np.array(conn_to, dtype=np.int32)),
+        ("conn_permissions", np.array(conn_permissions, dtype=np.uint64)),
+    ]
+    header = {
+        "sha1": digest,
+        "edge_ids": [e.getID() for e in edges],
+        "node_ids": [n.getID() for n in nodes],
+        "types": types,
+        "vclasses": vclasses,
+        "edge_params": dict([(str(i), e.getParams()) for i, e in enumerate(edges) if e.getParams()]),
+        "boundary": net.getBoundary(),
+        "ranges": net._ranges,
+        "arrays": {},
+    }
+    offset = 0
+    for name, array in arrays:
+        header["arrays"][name] = [array.dtype.str, list(array.shape), offset]
+        offset += _aligned(array.nbytes)
+    encoded = json.dumps(header).encode("utf8")
+    start = _aligned(len(MAGIC) + 8 + len(encoded))
+
+    tmpfile = cachefile + ".tmp"
+    with open(tmpfile, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<Q", len(encoded)))
+        f.write(encoded)
+        f.write(b"\0" * (start - len(MAGIC) - 8 - len(encoded)))
+        for name, array in arrays:
+            data = np.ascontiguousarray(array).tobytes()
+            f.write(data)
+            f.write(b"\0" * (_aligned(len(data)) - len(data)))
+    os.replace(tmpfile, cachefile)
+
+
+def _aligned(size):
+    return (size + 7) // 8 * 8
+
+
+def load_cache(cachefile, digest=None):
+    """maps the cache into memory, returns None if it is missing, broken or outdated"""
+    try:
+        with open(cachefile, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                return None
+            length = struct.unpack("<Q", f.read(8))[0]
+            header = json.loads(f.read(length).decode("utf8"))
+            if digest is not None and header["sha1"] != digest:
+                return None
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, OSError, ValueError, struct.error):
+        return None
+    start = _aligned(len(MAGIC) + 8 + length)
+    arrays = {}
+    for name, (dtype, shape, offset) in header["arrays"].items():
+        count = int(np.prod(shape)) if shape else 1
+        arrays[name] = np.frombuffer(buf, dtype=np.dtype(dtype), count=count,
+                                     offset=start + offset).reshape(shape)
+    return CompiledNet(header, arrays, buf)
+
+
+def readNet(netfile, cachefile=None, verbose=False):
+    """reads the net from its compiled cache, which is (re)built as needed"""
+    if cachefile is None:
+        cachefile = netfile + CACHE_SUFFIX
+    digest = file_digest(netfile)
+    net = load_cache(cachefile, digest)
+    if net is None:
+        if verbose:
+            print("compiling network cache %s" % cachefile)
+        compile_net(sumolib.net.readNet(netfile), digest, cachefile)
+        net = load_cache(cachefile, digest)
+    return net
+
+
+class CompiledNode:
+
+    def __init__(self, id, coord):
+        self._id = id
+        self._coord = coord
+        self._incoming = []
+        self._outgoing = []
+
+    def getID(self):
+        return self._id
+
+    def getCoord(self):
+        return self._coord
+
+    def getIncoming(self):
+        return self._incoming
+
+    def getOutgoing(self):
+        return self._outgoing
+
+
+class CompiledConnection:
+
+    def __init__(self, from_edge, to_edge, permissions):
+        self._from = from_edge
+        self._to = to_edge
+        self._permissions = permissions
+
+    def getFrom(self):
+        return self._from
+
+    def getTo(self):
+        return self._to
+
+
+class CompiledEdge:
+
+    def __init__(self, net, index):
+        self._net = net
+        self._index = index
+        self._id = net._edge_ids[index]
+        self._from = net._nodes[net._edge_from[index]]
+        self._to = net._nodes[net._edge_to[index]]
+        self._length = net._edge_length[index]
+        self._speed = net._edge_speed[index]
+        self._laneNumber = net._edge_lanes[index]
+        self._type = net._types[net._edge_type[index]]
+        self._permissions = net._edge_permissions[index]
+        self._fringe = net._edge_fringe[index]
+        self._params = net._edge_params.get(index, {})
+        self._incoming = {}
+        self._outgoing = {}
+
+    def getID(self):
+        return self._id
+
+    def getIndex(self):
+        return self._index
+
+    def getFromNode(self):
+        return self._from
+
+    def getToNode(self):
+        return self._to
+
+    def getLength(self):
+        return self._length
+
+    def getSpeed(self):
+        return self._speed
+
+    def getLaneNumber(self):
+        return self._laneNumber
+
+    def getType(self):
+        return self._type
+
+    def getParam(self, key, default=None):
+        return self._params.get(key, default)
+
+    def getParams(self):
+        return self._params
+
+    def getBoundingBox(self, includeJunctions=True):
+        return tuple(self._net.arrays["edge_bbox"][self._index].tolist())
+
+    def getIncoming(self):
+        return self._incoming
+
+    def getOutgoing(self):
+        return self._outgoing
+
+    def allows(self, vClass):
+        if vClass is None or vClass == "ignoring":
+            return True
+        return bool(self._permissions & self._net.vclass_bit(vClass))
+
+    def _allowed(self, connections, vClass):
+        if vClass is None or vClass == "ignoring":
+            return connections
+        bit = self._net.vclass_bit(vClass)
+        return dict([(e, conns) for e, conns in connections.items() if conns[0]._permissions & bit])
+
+    def getAllowedIncoming(self, vClass):
+        return self._allowed(self._incoming, vClass)
+
+    def getAllowedOutgoing(self, vClass):
+        return self._allowed(self._outgoing, vClass)
+
+    def is_fringe(self, connections=None, checkJunctions=False):
+        if connections is None:
+            return self._fringe != 0
+        if connections is self._incoming:
+            return bool(self._fringe & FRINGE_INCOMING)
+        if connections is self._outgoing:
+            return bool(self._fringe & FRINGE_OUTGOING)
+        return len(connections) == 0
+
+    def __repr__(self):
+        return '<edge id="%s" from="%s" to="%s"/>' % (self._id, self._from.getID(), self._to.getID())
+
+
+class CompiledNet:
+    """network loaded from the compiled cache, the arrays are available as net.arrays"""
+
+    def __init__(self, header, arrays, buf=None):
+        self.arrays = arrays
+        self._buf = buf  # keeps the memory map open
+        self._vclasses = dict([(v, 1 << i) for i, v in enumerate(header["vclasses"])])
+        self._boundary = header["boundary"]
+        self._ranges = header["ranges"]
+        self._types = header["types"]
+        self._edge_ids = header["edge_ids"]
+        self._edge_params = dict([(int(i), p) for i, p in header["edge_params"].items()])
+        self._edge_from = arrays["edge_from"].tolist()
+        self._edge_to = arrays["edge_to"].tolist()
+        self._edge_length = arrays["edge_length"].tolist()
+        self._edge_speed = arrays["edge_speed"].tolist()
+        self._edge_lanes = arrays["edge_lanes"].tolist()
+        self._edge_type = arrays["edge_type"].tolist()
+        self._edge_permissions = arrays["edge_permissions"].tolist()
+        self._edge_fringe = arrays["edge_fringe"].tolist()
+        self._nodes = [CompiledNode(id, (x, y)) for id, x, y in zip(
+            header["node_ids"], arrays["node_x"].tolist(), arrays["node_y"].tolist())]
+        self._id2node = dict([(n.getID(), n) for n in self._nodes])
+        self._edges = [CompiledEdge(self, i) for i in range(len(self._edge_ids))]
+        self._id2edge = dict([(e.getID(), e) for e in self._edges])
+        for edge in self._edges:
+            edge._from._outgoing.append(edge)
+            edge._to._incoming.append(edge)
+        for i, j, permissions in zip(arrays["conn_from"].tolist(), arrays["conn_to"].tolist(),
+                                     arrays["conn_permissions"].tolist()):
+            conn = CompiledConnection(self._edges[i], self._edges[j], permissions)
+            self._edges[i]._outgoing[self._edges[j]] = [conn]
+            self._edges[j]._incoming[self._edges[i]] = [conn]
+
+    def vclass_bit(self, vClass):
+        return self._vclasses.get(vClass, 0)
+
+    def getEdges(self):
+        return self._edges
+
+    def getEdge(self, id):
+        return self._id2edge[id]
+
+    def hasEdge(self, id):
+        return id in self._id2edge
+
+    def getNodes(self):
+        return self._nodes
+
+    def getNode(self, id):
+        return self._id2node[id]
+
+    def hasNode(self, id):
+        return id in self._id2node
+
+    def getBoundary(self):
+        return list(self._boundary)
+
+    def getBBoxDiameter(self):
+        return math.sqrt(
+            (self._ranges[0][0] - self._ranges[0][1]) ** 2 +
+            (self._ranges[1][0] - self._ranges[1][1]) ** 2)
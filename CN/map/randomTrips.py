@@ -24,9 +24,19 @@ import os
 import sys
 import random
 import bisect
+import heapq
+import re
+import json
+import struct
 import subprocess
+import multiprocessing
+from array import array
 from collections import defaultdict
 import math
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 if 'SUMO_HOME' in os.environ:
     sys.path.append(os.path.join(os.environ['SUMO_HOME'], 'tools'))
@@ -45,17 +55,31 @@ def get_options(args=None):
     optParser = sumolib.options.ArgumentParser(description="Generate trips between random locations")
     optParser.add_argument("-n", "--net-file", dest="netfile",
                            help="define the net file (mandatory)")
+    optParser.add_argument("--net-cache", dest="net_cache", action="store_true", default=False,
+                           help="load the network from a compiled binary cache next to the net file, which is " +
+                           "rebuilt whenever the net file changes (requires numpy)")
     optParser.add_argument("-a", "--additional-files", dest="additional",
                            help="define additional files to be loaded by the router")
     optParser.add_argument("-o", "--output-trip-file", dest="tripfile",
                            default="trips.trips.xml", help="define the output trip filename")
     optParser.add_argument("-r", "--route-file", dest="routefile",
-                           help="generates route file with duarouter")
+                           help="generates route file (see option --router)")
+    optParser.add_argument("--router", default="duarouter", choices=["duarouter", "internal"],
+                           help="compute routes and validated trips by calling duarouter (default) or within this " +
+                           "process (A* on travel time over the loaded net). Options the internal router does not " +
+                           "support (persons, flows, junction taz, additional files, loop removal) use duarouter")
+    optParser.add_argument("--duarouter-shards", type=int, dest="duarouter_shards", default=1, metavar="K",
+                           help="split the trips into K time windows which are routed by parallel duarouter " +
+                           "processes and merged afterwards (default 1)")
     optParser.add_argument("--vtype-output", dest="vtypeout",
                            help="Store generated vehicle types in a separate file")
     optParser.add_argument("--weights-prefix", dest="weightsprefix",
                            help="loads probabilities for being source, destination and via-edge from the files named " +
-                           "<prefix>.src.xml, <prefix>.sink.xml and <prefix>.via.xml")
+                           "<prefix>.src.xml, <prefix>.sink.xml and <prefix>.via.xml. Files with several " +
+                           "<interval> elements select the weights by depart time")
+    optParser.add_argument("--weights-cache", action="store_true", dest="weights_cache", default=False,
+                           help="store the parsed weights files in binary sidecar files <file>.cache and load " +
+                           "them from there for as long as the weights file is unchanged")
     optParser.add_argument("--weights-output-prefix", dest="weights_outprefix",
                            help="generates weights files for visualisation")
     optParser.add_argument("--pedestrians", action="store_true",
@@ -82,6 +106,10 @@ def get_options(args=None):
     optParser.add_argument(
         "-p", "--period", type=float, default=1, help="Generate vehicles with equidistant departure times and " +
         "period=FLOAT (default 1.0). If option --binomial is used, the expected arrival rate is set to 1/period.")
+    optParser.add_argument("--demand-profile", dest="demand_profile", metavar="FILE",
+                           help="generate departures as a Poisson process with the piecewise constant rates given " +
+                           "in FILE (lines of 'begin end vehicles-per-hour', '#' starts a comment) instead of " +
+                           "using --period")
     optParser.add_argument("-s", "--seed", type=int, default=42, help="random seed")
     optParser.add_argument("--random", action="store_true",
                            default=False, help="use a random seed to initialize the random number generator")
@@ -118,10 +146,30 @@ def get_options(args=None):
                            default=0, help="generates the given number of intermediate way points")
     optParser.add_argument("--flows", type=int, default=0,
                            help="generates INT flows that together output vehicles with the specified period")
+    optParser.add_argument("--aggregate-flows", type=float, dest="aggregate_flows", metavar="SECONDS",
+                           help="replace the trips with identical from, to, via and attributes which depart within " +
+                           "the same time bucket of the given length by a single flow")
+    optParser.add_argument("--aggregate-min", type=int, dest="aggregate_min", default=5,
+                           help="minimum number of trips for building a flow with option --aggregate-flows (default 5)")
+    optParser.add_argument("--aggregate-mode", dest="aggregate_mode", default="probability",
+                           choices=["probability", "period"],
+                           help="flows keep the expected number of trips with random departures (probability, " +
+                           "default) or the exact number with equidistant departures (period)")
     optParser.add_argument("--jtrrouter", action="store_true",
                            default=False, help="Create flows without destination as input for jtrrouter")
     optParser.add_argument("--maxtries", type=int, default=100,
                            help="number of attemps for finding a trip which meets the distance constraints")
+    optParser.add_argument("--draw-batch", type=int, dest="draw_batch", default=0, metavar="N",
+                           help="draw random edges in batches of N from an alias table (faster for many trips, " +
+                           "uses numpy if available and yields a different random sequence than the default)")
+    optParser.add_argument("--stratify-sinks", dest="stratify_sinks", action="store_true", default=False,
+                           help="draw destinations only from grid cells within the allowed distance of the origin " +
+                           "instead of rejecting trips that violate --min-distance/--max-distance (requires numpy)")
+    optParser.add_argument("--sink-cell-size", type=float, dest="sink_cell_size", default=100.0,
+                           help="grid cell size in m for option --stratify-sinks (default 100)")
+    optParser.add_argument("-j", "--jobs", type=int, default=1,
+                           help="generate the trips of INT consecutive time chunks in parallel processes; the " +
+                           "output is reproducible for a given seed and number of jobs (default 1)")
     optParser.add_argument("--binomial", type=int, metavar="N",
                            help="If this is set, the number of departures per second will be drawn from a binomial " +
                            "distribution with n=N and p=PERIOD/N where PERIOD is the argument given to --period")
@@ -162,6 +210,28 @@ def get_options(args=None):
         print("Error: Period must be positive", file=sys.stderr)
         sys.exit(1)
 
+    if options.duarouter_shards < 1:
+        print("Error: Number of duarouter shards must be positive", file=sys.stderr)
+        sys.exit(1)
+
+    if options.jobs < 1:
+        print("Error: Number of jobs must be positive", file=sys.stderr)
+        sys.exit(1)
+
+    if options.demand_profile and (options.flows > 0 or options.binomial):
+        print("Error: Option --demand-profile cannot be used together with option --flows or --binomial",
+              file=sys.stderr)
+        sys.exit(1)
+
+    if options.aggregate_flows is not None:
+        if options.aggregate_flows <= 0:
+            print("Error: Time bucket for option --aggregate-flows must be positive", file=sys.stderr)
+            sys.exit(1)
+        if options.flows > 0 or options.pedestrians:
+            print("Error: Option --aggregate-flows cannot be used together with option --flows or for persons",
+                  file=sys.stderr)
+            sys.exit(1)
+
     if options.jtrrouter and options.flows <= 0:
         print("Error: Option --jtrrouter must be used with option --flows", file=sys.stderr)
         sys.exit(1)
@@ -187,60 +257,307 @@ def get_options(args=None):
 class InvalidGenerator(Exception):
     pass
 
+
+# Walker's alias method (in Vose's formulation) for drawing from a discrete
+# distribution in O(1) per draw after O(n) setup. Draws are vectorized with numpy.
+class AliasTable:
+
+    def __init__(self, weights):
+        n = len(weights)
+        total = float(sum(weights))
+        scaled = [w * n / total for w in weights]
+        prob = [1.0] * n
+        alias = list(range(n))
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            s = small.pop()
+            g = large.pop()
+            prob[s] = scaled[s]
+            alias[s] = g
+            scaled[g] += scaled[s] - 1.0
+            if scaled[g] < 1.0:
+                small.append(g)
+            else:
+                large.append(g)
+        # whatever remains is 1.0 up to rounding errors
+        self.prob = np.array(prob)
+        self.alias = np.array(alias, dtype=np.int64)
+
+    def sample(self, n, rng):
+        columns = rng.integers(0, len(self.prob), size=n)
+        coins = rng.random(n)
+        return np.where(coins < self.prob[columns], columns, self.alias[columns])
+
 # assigns a weight to each edge using weight_fun and then draws from a discrete
 # distribution with these weights
 
 
 class RandomEdgeGenerator:
 
-    def __init__(self, net, weight_fun):
+    def __init__(self, net, weight_fun, batch_size=0, weights=None):
         self.net = net
         self.weight_fun = weight_fun
+        # weights may be given precomputed (see edge_weights), otherwise weight_fun is called per edge
+        self.weights = weights if weights is not None else [weight_fun(edge) for edge in self.net._edges]
         self.cumulative_weights = []
         self.total_weight = 0
-        for edge in self.net._edges:
-            # print edge.getID(), weight_fun(edge)
-            self.total_weight += weight_fun(edge)
+        for weight in self.weights:
+            self.total_weight += weight
             self.cumulative_weights.append(self.total_weight)
         if self.total_weight == 0:
             raise InvalidGenerator()
+        # if batch_size > 0, get() serves edges from batches drawn with get_batch
+        self.batch_size = batch_size
+        self.batch = []
+        self.alias_table = None
+        self.rng = None
 
     def get(self):
+        if self.batch_size > 0:
+            if not self.batch:
+                self.batch = list(self.get_batch(self.batch_size))
+                self.batch.reverse()
+            return self.net._edges[self.batch.pop()]
         r = random.random() * self.total_weight
         index = bisect.bisect(self.cumulative_weights, r)
         return self.net._edges[index]
 
+    def reset(self):
+        # drops buffered draws, so that the next draws only depend on the state of random
+        self.batch = []
+        self.rng = None
+
+    def get_batch(self, n):
+        # returns the indices (into net._edges) of n randomly drawn edges
+        if np is None:
+            return [bisect.bisect(self.cumulative_weights, random.random() * self.total_weight)
+                    for _ in range(n)]
+        if self.alias_table is None:
+            # seeded from the python generator to stay reproducible with --seed
+            self.alias_table = AliasTable(self.weights)
+            self.rng = np.random.default_rng(random.getrandbits(64))
+        return self.alias_table.sample(n, self.rng).tolist()
+
     def write_weights(self, fname, interval_id, begin, end):
+        with open(fname, 'w+') as f:
+            f.write('<edgedata>\n')
+            self.write_interval(f, interval_id, begin, end)
+            f.write('</edgedata>\n')
+
+    def write_interval(self, f, interval_id, begin, end):
         # normalize to [0,100]
-        normalizer = 100.0 / max(1, max(map(self.weight_fun, self.net._edges)))
-        weights = [(self.weight_fun(e) * normalizer, e.getID()) for e in self.net.getEdges()]
+        normalizer = 100.0 / max(1, max(self.weights))
+        weights = [(w * normalizer, e.getID()) for w, e in zip(self.weights, self.net.getEdges())]
         weights.sort(reverse=True)
+        f.write('    <interval id="%s" begin="%s" end="%s">\n' % (
+            interval_id, begin, end))
+        for weight, edgeID in weights:
+            f.write('        <edge id="%s" value="%0.2f"/>\n' %
+                    (edgeID, weight))
+        f.write('    </interval>\n')
+
+
+# one RandomEdgeGenerator per interval of a weights file. set_time selects the
+# generator of the interval containing the given time (before the first
+# interval the first one is used, after an interval the last one started)
+
+
+class IntervalEdgeGenerator:
+
+    def __init__(self, net, props, batch_size=0):
+        self.net = net
+        self.begins = [begin for begin, _, _ in props.intervals]
+        self.ends = [end for _, end, _ in props.intervals]
+        self.generators = []
+        for index in range(len(props.intervals)):
+            try:
+                self.generators.append(RandomEdgeGenerator(net, None, batch_size, props.weights(net, index)))
+            except InvalidGenerator:
+                # no departures (or arrivals) at all during this interval
+                self.generators.append(None)
+        if not any(self.generators):
+            raise InvalidGenerator()
+        self.index = 0
+
+    @property
+    def weights(self):
+        generator = self.generators[self.index]
+        return generator.weights if generator else [0] * len(self.net._edges)
+
+    def set_time(self, time):
+        self.index = max(0, bisect.bisect_right(self.begins, time) - 1)
+
+    def get(self):
+        generator = self.generators[self.index]
+        if generator is None:
+            raise Exception("no valid edges in the weights interval [%s, %s)" % (
+                self.begins[self.index], self.ends[self.index]))
+        return generator.get()
+
+    def reset(self):
+        for generator in self.generators:
+            if generator is not None:
+                generator.reset()
+
+    def write_weights(self, fname, interval_id, begin, end):
         with open(fname, 'w+') as f:
             f.write('<edgedata>\n')
-            f.write('    <interval id="%s" begin="%s" end="%s">\n' % (
-                interval_id, begin, end))
-            for weight, edgeID in weights:
-                f.write('        <edge id="%s" value="%0.2f"/>\n' %
-                        (edgeID, weight))
-            f.write('    </interval>\n')
+            for index, generator in enumerate(self.generators):
+                if generator is not None:
+                    generator.write_interval(f, "%s_%s" % (interval_id, index), self.begins[index], self.ends[index])
             f.write('</edgedata>\n')
 
 
+# buckets the edges of a sink generator into a grid by their destination
+# coordinate. For a given origin, sinks are drawn (by weight) only from the
+# cells which intersect the annulus of allowed distances. If these cells hold
+# few edges, the exact distances are checked up front, otherwise only draws
+# from the cells on the border of the annulus may need to be rejected
+
+
+class StratifiedSinkSampler:
+
+    def __init__(self, sink_generator, pedestrians, cell_size, maxtries=100, exact_limit=1024):
+        self.edges = sink_generator.net._edges
+        self.maxtries = maxtries
+        self.exact_limit = exact_limit
+        cells = defaultdict(list)
+        for index, weight in enumerate(sink_generator.weights):
+            if weight > 0:
+                edge = self.edges[index]
+                node = edge.getFromNode() if pedestrians else edge.getToNode()
+                x, y = node.getCoord()[:2]
+                cells[(math.floor(x / cell_size), math.floor(y / cell_size))].append((index, weight, x, y))
+        # the members of cell i are the entries offsets[i]:offsets[i + 1] of
+        # indices, weights, cumulative (per cell), xs and ys
+        keys = sorted(cells)
+        members = [m for key in keys for m in cells[key]]
+        self.indices = [m[0] for m in members]
+        self.weights = np.array([m[1] for m in members], dtype=float)
+        self.xs = np.array([m[2] for m in members], dtype=float)
+        self.ys = np.array([m[3] for m in members], dtype=float)
+        self.offsets = np.cumsum([0] + [len(cells[key]) for key in keys])
+        self.cumulative = []
+        for start, end in zip(self.offsets[:-1], self.offsets[1:]):
+            self.cumulative.append(np.cumsum(self.weights[start:end]).tolist())
+        self.cell_weights = np.array([c[-1] for c in self.cumulative], dtype=float)
+        self.cell_sizes = np.diff(self.offsets)
+        bounds = [(cx * cell_size, cy * cell_size, (cx + 1) * cell_size, (cy + 1) * cell_size) for cx, cy in keys]
+        self.x0, self.y0, self.x1, self.y1 = np.array(bounds, dtype=float).reshape(-1, 4).T
+        self.drawn = 0
+        self.accepted = 0
+
+    def get(self, origin, min_distance, max_distance):
+        ox, oy = origin[:2]
+        # closest and farthest distance of each cell to the origin
+        near = np.hypot(np.maximum(np.maximum(self.x0 - ox, ox - self.x1), 0),
+                        np.maximum(np.maximum(self.y0 - oy, oy - self.y1), 0))
+        far = np.hypot(np.maximum(np.abs(self.x0 - ox), np.abs(self.x1 - ox)),
+                       np.maximum(np.abs(self.y0 - oy), np.abs(self.y1 - oy)))
+        mask = far >= min_distance
+        if max_distance is not None:
+            mask &= near < max_distance
+        candidates = np.flatnonzero(mask)
+        if len(candidates) == 0:
+            return None
+
+        if self.cell_sizes[candidates].sum() <= self.exact_limit:
+            members = np.concatenate([np.arange(self.offsets[c], self.offsets[c + 1]) for c in candidates])
+            distances = np.hypot(self.xs[members] - ox, self.ys[members] - oy)
+            valid = distances >= min_distance
+            if max_distance is not None:
+                valid &= distances < max_distance
+            members = members[valid]
+            self.drawn += 1
+            if len(members) == 0:
+                return None
+            cumulative = np.cumsum(self.weights[members])
+            self.accepted += 1
+            chosen = members[np.searchsorted(cumulative, random.random() * cumulative[-1], side="right")]
+            return self.edges[self.indices[chosen]]
+
+        cumulative = np.cumsum(self.cell_weights[candidates])
+        total = cumulative[-1]
+        for _ in range(self.maxtries):
+            self.drawn += 1
+            cell = candidates[np.searchsorted(cumulative, random.random() * total, side="right")]
+            cell_cumulative = self.cumulative[cell]
+            chosen = self.offsets[cell] + bisect.bisect(cell_cumulative, random.random() * cell_cumulative[-1])
+            distance = euclidean(origin, (self.xs[chosen], self.ys[chosen]))
+            if distance >= min_distance and (max_distance is None or distance < max_distance):
+                self.accepted += 1
+                return self.edges[self.indices[chosen]]
+        return None
+
+    def acceptance_rate(self):
+        return self.accepted / self.drawn if self.drawn else 1.0
+
+
+# a StratifiedSinkSampler for each interval of an IntervalEdgeGenerator
+
+
+class IntervalSinkSampler:
+
+    def __init__(self, sink_generator, pedestrians, cell_size, maxtries=100):
+        self.sink_generator = sink_generator
+        self.samplers = [StratifiedSinkSampler(generator, pedestrians, cell_size, maxtries) if generator else None
+                         for generator in sink_generator.generators]
+        self.drawn = 0
+        self.accepted = 0
+
+    def get(self, origin, min_distance, max_distance):
+        sampler = self.samplers[self.sink_generator.index]
+        if sampler is None:
+            return None
+        drawn, accepted = sampler.drawn, sampler.accepted
+        sink_edge = sampler.get(origin, min_distance, max_distance)
+        self.drawn += sampler.drawn - drawn
+        self.accepted += sampler.accepted - accepted
+        return sink_edge
+
+    def acceptance_rate(self):
+        return self.accepted / self.drawn if self.drawn else 1.0
+
+
 class RandomTripGenerator:
 
-    def __init__(self, source_generator, sink_generator, via_generator, intermediate, pedestrians):
+    def __init__(self, source_generator, sink_generator, via_generator, intermediate, pedestrians,
+                 sink_sampler=None, reachability=None):
         self.source_generator = source_generator
         self.sink_generator = sink_generator
         self.via_generator = via_generator
         self.intermediate = intermediate
         self.pedestrians = pedestrians
+        self.sink_sampler = sink_sampler
+        self.reachability = reachability
+
+    def reset(self):
+        for generator in (self.source_generator, self.sink_generator, self.via_generator):
+            if generator is not None:
+                generator.reset()
+
+    def set_time(self, time):
+        # selects the weights interval of generators loaded from time-varying weights files
+        for generator in (self.source_generator, self.sink_generator, self.via_generator):
+            if isinstance(generator, IntervalEdgeGenerator):
+                generator.set_time(time)
 
     def get_trip(self, min_distance, max_distance, maxtries=100, junctionTaz=False):
         for _ in range(maxtries):
             source_edge = self.source_generator.get()
             intermediate = [self.via_generator.get()
                             for i in range(self.intermediate)]
-            sink_edge = self.sink_generator.get()
+            if self.sink_sampler is not None:
+                # the last leg has to cover whatever the way points leave open
+                points = [source_edge.getFromNode().getCoord()] + [e.getFromNode().getCoord() for e in intermediate]
+                covered = sum([euclidean(p, q) for p, q in zip(points[:-1], points[1:])])
+                sink_edge = self.sink_sampler.get(points[-1], min_distance - covered,
+                                                  None if max_distance is None else max_distance - covered)
+                if sink_edge is None:
+                    continue
+            else:
+                sink_edge = self.sink_generator.get()
             if self.pedestrians:
                 destCoord = sink_edge.getFromNode().getCoord()
             else:
@@ -251,6 +568,9 @@ class RandomTripGenerator:
                       [destCoord])
             distance = sum([euclidean(p, q)
                             for p, q in zip(coords[:-1], coords[1:])])
+            if self.reachability is not None and not self.reachability.connects(
+                    [source_edge] + intermediate + [sink_edge]):
+                continue
             if (distance >= min_distance
                     and (not junctionTaz or source_edge.getFromNode() != sink_edge.getToNode())
                     and (max_distance is None or distance < max_distance)):
@@ -314,47 +634,233 @@ def get_prob_fun(options, fringe_bonus, fringe_forbidden, max_length):
     return edge_probability
 
 
+# the edge attributes evaluated by get_prob_fun as columns (numpy arrays),
+# taken from the compiled net cache where available
+
+
+class EdgeColumns:
+
+    def __init__(self, net, options):
+        edges = net._edges
+        arrays = getattr(net, "arrays", None)
+        if arrays is not None:
+            self.length = arrays["edge_length"]
+            self.speed = arrays["edge_speed"]
+            self.lanes = arrays["edge_lanes"]
+            self.fringe_in = (arrays["edge_fringe"] & 1) != 0
+            self.fringe_out = (arrays["edge_fringe"] & 2) != 0
+        else:
+            self.length = np.array([e.getLength() for e in edges], dtype=float)
+            self.speed = np.array([e.getSpeed() for e in edges], dtype=float)
+            self.lanes = np.array([e.getLaneNumber() for e in edges])
+            self.fringe_in = np.array([e.is_fringe(e._incoming) for e in edges], dtype=bool)
+            self.fringe_out = np.array([e.is_fringe(e._outgoing) for e in edges], dtype=bool)
+        self.fringe = self.fringe_in | self.fringe_out
+        if options.vclass:
+            self.allowed = np.array([e.allows(options.vclass) for e in edges], dtype=bool)
+        if options.viaEdgeTypes is not None:
+            self.via_type = np.array([e.getType() in options.viaEdgeTypes for e in edges], dtype=bool)
+        if options.edgeParam is not None:
+            self.param = np.array([float(e.getParam(options.edgeParam, 1.0)) for e in edges], dtype=float)
+        if options.angle_weight != 1.0:
+            if arrays is not None:
+                xmin, ymin, xmax, ymax = arrays["edge_bbox"].T
+            else:
+                xmin, ymin, xmax, ymax = np.array([e.getBoundingBox() for e in edges], dtype=float).reshape(-1, 4).T
+            self.center_x = (xmin + xmax) / 2
+            self.center_y = (ymin + ymax) / 2
+
+
+def normalize_angles(a, lower, upper, circle):
+    # vectorized sumolib.geomhelper.normalizeAngle
+    while (a < lower).any():
+        a = np.where(a < lower, a + circle, a)
+    while (a > upper).any():
+        a = np.where(a > upper, a - circle, a)
+    return a
+
+
+def edge_weights(options, columns, fringe_bonus, fringe_forbidden, max_length):
+    # vectorized get_prob_fun: the weights of all edges in a single pass,
+    # evaluated in the same order so that they are identical
+    valid = np.ones(len(columns.length), dtype=bool)
+    if options.vclass:
+        valid &= columns.allowed  # not allowed
+    if fringe_bonus is None and not options.pedestrians:
+        valid &= ~columns.fringe  # not suitable as intermediate way point
+    if fringe_forbidden is not None and not options.pedestrians:
+        forbidden = columns.fringe_in if fringe_forbidden == "_incoming" else columns.fringe_out
+        if options.allow_fringe_min_length is not None:
+            forbidden = forbidden & (columns.length < options.allow_fringe_min_length)
+        valid &= ~forbidden  # the wrong kind of fringe
+    if fringe_bonus is not None and options.viaEdgeTypes is not None:
+        valid &= ~(~columns.fringe & columns.via_type)  # only allows depart and arrival on the fringe
+    prob = np.ones(len(columns.length))
+    if options.length:
+        if options.fringe_factor != 1.0 and fringe_bonus is not None:
+            prob = prob * np.where(columns.fringe, max_length, columns.length)
+        else:
+            prob = prob * columns.length
+    if options.lanes:
+        prob = prob * columns.lanes
+    prob = prob * np.where(columns.fringe, columns.speed ** options.fringe_speed_exponent,
+                           columns.speed ** options.speed_exponent)
+    if options.fringe_factor != 1.0 and not options.pedestrians and fringe_bonus is not None:
+        bonus = columns.speed > options.fringe_threshold
+        bonus &= columns.fringe_in if fringe_bonus == "_incoming" else columns.fringe_out
+        prob = np.where(bonus, prob * options.fringe_factor, prob)
+    if options.edgeParam is not None:
+        prob = prob * columns.param
+    if options.angle_weight != 1.0 and fringe_bonus is not None:
+        nx, ny = options.angle_center
+        # math.atan2 instead of np.arctan2, the latter may round differently in the last bit
+        rad = np.fromiter(map(math.atan2, (columns.center_y - ny).tolist(), (columns.center_x - nx).tolist()),
+                          dtype=float, count=len(columns.center_x))
+        edgeAngle = normalize_angles(np.degrees(math.pi / 2. - rad), 0, 360, 360)
+        angleDiff = np.minimum(normalize_angles(options.angle - edgeAngle, 0, 360, 360),
+                               normalize_angles(edgeAngle - options.angle, 0, 360, 360))
+        if fringe_bonus == "_incoming":
+            # source edge
+            prob = prob * (angleDiff * (options.angle_weight - 1) + 1)
+        else:
+            prob = prob * ((180 - angleDiff) * (options.angle_weight - 1) + 1)
+    return np.where(valid, prob, 0.0).tolist()
+
+
+# the edge values of each <interval> of a weights file as (begin, end, values).
+# A file without intervals has a single interval which is valid at all times
+
+
 class LoadedProps:
 
-    def __init__(self, fname):
-        self.weights = defaultdict(lambda: 0)
-        for edge in sumolib.output.parse_fast(fname, 'edge', ['id', 'value']):
-            self.weights[edge.id] = float(edge.value)
+    CACHE_MAGIC = b"WEIGHTS3\n"
+
+    def __init__(self, fname, use_cache=False):
+        self.intervals = None
+        cachefile = fname + ".cache"
+        if use_cache:
+            import netcache
+            digest = netcache.file_digest(fname)
+            self.intervals = self.load_cache(cachefile, digest)
+        if self.intervals is None:
+            self.intervals = self.parse(fname)
+            if use_cache:
+                self.write_cache(cachefile, digest)
+
+    def parse(self, fname):
+        intervals = []
+        for interval in sumolib.xml.parse(fname, 'interval'):
+            values = {}
+            for edge in interval.getChild('edge') if interval.hasChild('edge') else []:
+                if edge.hasAttribute('value'):
+                    values[edge.id] = float(edge.value)
+            intervals.append((sumolib.miscutils.parseTime(interval.begin),
+                              sumolib.miscutils.parseTime(interval.end), values))
+        if not intervals:
+            values = {}
+            for edge in sumolib.output.parse_fast(fname, 'edge', ['id', 'value']):
+                values[edge.id] = float(edge.value)
+            intervals.append((0, float("inf"), values))
+        intervals.sort(key=lambda interval: interval[0])
+        return intervals
+
+    def write_cache(self, cachefile, digest):
+        # binary sidecar keyed by the SHA-1 of the weights file (as in netcache):
+        # MAGIC, the length of a JSON header (8 bytes little endian), the header
+        # with the edge ids and intervals, then per interval the int32 edge
+        # numbers and float64 values. Unlike a pickle, loading a foreign cache
+        # file cannot execute code
+        edge_ids = sorted(set([edge for _, _, values in self.intervals for edge in values]))
+        number = dict([(edge, i) for i, edge in enumerate(edge_ids)])
+        header = {"sha1": digest, "byteorder": sys.byteorder, "edge_ids": edge_ids,
+                  "intervals": [[begin, end, len(values)] for begin, end, values in self.intervals]}
+        encoded = json.dumps(header).encode("utf8")
+        tmpfile = cachefile + ".tmp"
+        with open(tmpfile, 'wb') as f:
+            f.write(self.CACHE_MAGIC)
+            f.write(struct.pack("<Q", len(encoded)))
+            f.write(encoded)
+            for _, _, values in self.intervals:
+                f.write(array('i', [number[edge] for edge in values]).tobytes())
+                f.write(array('d', list(values.values())).tobytes())
+        os.replace(tmpfile, cachefile)
+
+    def load_cache(self, cachefile, digest):
+        # returns None if the cache is missing, outdated or unreadable
+        try:
+            with open(cachefile, 'rb') as f:
+                if f.read(len(self.CACHE_MAGIC)) != self.CACHE_MAGIC:
+                    return None
+                length = struct.unpack("<Q", f.read(8))[0]
+                header = json.loads(f.read(length).decode("utf8"))
+                if header["sha1"] != digest:
+                    return None
+                edge_ids = header["edge_ids"]
+                intervals = []
+                for begin, end, count in header["intervals"]:
+                    numbers = array('i')
+                    numbers.frombytes(f.read(numbers.itemsize * count))
+                    values = array('d')
+                    values.frombytes(f.read(values.itemsize * count))
+                    if len(numbers) != count or len(values) != count:
+                        return None
+                    if header["byteorder"] != sys.byteorder:
+                        numbers.byteswap()
+                        values.byteswap()
+                    intervals.append((float(begin), float(end),
+                                      dict(zip([edge_ids[i] for i in numbers], values))))
+                return intervals
+        except (IOError, OSError, ValueError, KeyError, TypeError, IndexError, struct.error):
+            return None
 
-    def __call__(self, edge):
-        return self.weights[edge.getID()]
+    def weights(self, net, index):
+        values = self.intervals[index][2]
+        return [values.get(edge.getID(), 0) for edge in net._edges]
 
 
 def buildTripGenerator(net, options):
+    columns = EdgeColumns(net, options) if np is not None else None
+
+    def prob_generator(fringe_bonus, fringe_forbidden, max_length):
+        weights = None
+        if columns is not None:
+            weights = edge_weights(options, columns, fringe_bonus, fringe_forbidden, max_length)
+        return RandomEdgeGenerator(net, get_prob_fun(options, fringe_bonus, fringe_forbidden, max_length),
+                                   options.draw_batch, weights)
+
+    def loaded_generator(fname):
+        props = LoadedProps(fname, options.weights_cache)
+        if len(props.intervals) == 1:
+            return RandomEdgeGenerator(net, None, options.draw_batch, props.weights(net, 0))
+        return IntervalEdgeGenerator(net, props, options.draw_batch)
+
     try:
         max_length = 0
-        for edge in net.getEdges():
-            if not edge.is_fringe():
-                max_length = max(max_length, edge.getLength())
+        if columns is not None:
+            if not columns.fringe.all():
+                max_length = max(0, columns.length[~columns.fringe].max())
+        else:
+            for edge in net.getEdges():
+                if not edge.is_fringe():
+                    max_length = max(max_length, edge.getLength())
         forbidden_source_fringe = None if options.allow_fringe else "_outgoing"
         forbidden_sink_fringe = None if options.allow_fringe else "_incoming"
-        source_generator = RandomEdgeGenerator(
-            net, get_prob_fun(options, "_incoming", forbidden_source_fringe, max_length))
-        sink_generator = RandomEdgeGenerator(
-            net, get_prob_fun(options, "_outgoing", forbidden_sink_fringe, max_length))
+        source_generator = prob_generator("_incoming", forbidden_source_fringe, max_length)
+        sink_generator = prob_generator("_outgoing", forbidden_sink_fringe, max_length)
         if options.weightsprefix:
             if os.path.isfile(options.weightsprefix + SOURCE_SUFFIX):
-                source_generator = RandomEdgeGenerator(
-                    net, LoadedProps(options.weightsprefix + SOURCE_SUFFIX))
+                source_generator = loaded_generator(options.weightsprefix + SOURCE_SUFFIX)
             if os.path.isfile(options.weightsprefix + SINK_SUFFIX):
-                sink_generator = RandomEdgeGenerator(
-                    net, LoadedProps(options.weightsprefix + SINK_SUFFIX))
+                sink_generator = loaded_generator(options.weightsprefix + SINK_SUFFIX)
     except InvalidGenerator:
         print("Error: no valid edges for generating source or destination. Try using option --allow-fringe",
               file=sys.stderr)
         return None
 
     try:
-        via_generator = RandomEdgeGenerator(
-            net, get_prob_fun(options, None, None, 1))
+        via_generator = prob_generator(None, None, 1)
         if options.weightsprefix and os.path.isfile(options.weightsprefix + VIA_SUFFIX):
-            via_generator = RandomEdgeGenerator(
-                net, LoadedProps(options.weightsprefix + VIA_SUFFIX))
+            via_generator = loaded_generator(options.weightsprefix + VIA_SUFFIX)
     except InvalidGenerator:
         if options.intermediate > 0:
             print(
@@ -363,8 +869,242 @@ def buildTripGenerator(net, options):
         else:
             via_generator = None
 
+    sink_sampler = None
+    if options.stratify_sinks:
+        if np is None:
+            print("Warning: option --stratify-sinks requires numpy, falling back to rejection sampling",
+                  file=sys.stderr)
+        elif isinstance(sink_generator, IntervalEdgeGenerator):
+            sink_sampler = IntervalSinkSampler(
+                sink_generator, options.pedestrians, options.sink_cell_size, options.maxtries)
+        else:
+            sink_sampler = StratifiedSinkSampler(
+                sink_generator, options.pedestrians, options.sink_cell_size, options.maxtries)
+
+    reachability = None
+    if use_reachability(options):
+        reachability = ReachabilityIndex(net, options.vclass)
+        if options.verbose:
+            print("reachability index: %s strongly connected components, the largest with %s of %s edges" % (
+                len(reachability.successors), reachability.largest, len(net._edges)))
+
     return RandomTripGenerator(
-        source_generator, sink_generator, via_generator, options.intermediate, options.pedestrians)
+        source_generator, sink_generator, via_generator, options.intermediate, options.pedestrians, sink_sampler,
+        reachability)
+
+
+# strongly connected components (Tarjan) of the edge graph restricted to the
+# given vClass and their condensation DAG. Edges of the same component reach
+# each other, otherwise the components reachable from the source component are
+# collected by a search on the DAG, which is cached per source component and
+# stops at components already searched (usually the largest one)
+
+
+class ReachabilityIndex:
+
+    def __init__(self, net, vclass):
+        self.vclass = vclass
+        self.component = {}
+        self.successors = []
+        self.reached_cache = {}
+        self.largest = 0
+        index = {}
+        lowlink = {}
+        stack = []
+        on_stack = set()
+        for root in net.getEdges():
+            if root in index:
+                continue
+            index[root] = lowlink[root] = len(index)
+            stack.append(root)
+            on_stack.add(root)
+            work = [(root, iter(self.outgoing(root)))]
+            while work:
+                edge, successors = work[-1]
+                for succ in successors:
+                    if succ not in index:
+                        index[succ] = lowlink[succ] = len(index)
+                        stack.append(succ)
+                        on_stack.add(succ)
+                        work.append((succ, iter(self.outgoing(succ))))
+                        break
+                    elif succ in on_stack:
+                        lowlink[edge] = min(lowlink[edge], index[succ])
+                else:
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        lowlink[parent] = min(lowlink[parent], lowlink[edge])
+                    if lowlink[edge] == index[edge]:
+                        self.add_component(stack, on_stack, edge)
+
+    def outgoing(self, edge):
+        if self.vclass:
+            return edge.getAllowedOutgoing(self.vclass)
+        return edge.getOutgoing()
+
+    def add_component(self, stack, on_stack, root):
+        # components are completed in reverse topological order, so every
+        # successor of a component has a smaller number
+        c = len(self.successors)
+        members = []
+        while True:
+            edge = stack.pop()
+            on_stack.discard(edge)
+            self.component[edge] = c
+            members.append(edge)
+            if edge == root:
+                break
+        successors = set()
+        for edge in members:
+            for succ in self.outgoing(edge):
+                other = self.component[succ]
+                if other != c:
+                    successors.add(other)
+        self.successors.append(successors)
+        self.largest = max(self.largest, len(members))
+
+    def reached(self, c):
+        reached = self.reached_cache.get(c)
+        if reached is None:
+            reached = set([c])
+            todo = [c]
+            while todo:
+                for other in self.successors[todo.pop()]:
+                    if other in reached:
+                        continue
+                    known = self.reached_cache.get(other)
+                    if known is not None:
+                        reached |= known
+                    else:
+                        reached.add(other)
+                        todo.append(other)
+            self.reached_cache[c] = reached
+        return reached
+
+    def reachable(self, source, target):
+        c = self.component[source]
+        other = self.component[target]
+        if c == other:
+            return True
+        if other > c:
+            return False
+        return other in self.reached(c)
+
+    def connects(self, edges):
+        return all([self.reachable(a, b) for a, b in zip(edges[:-1], edges[1:])])
+
+
+def use_reachability(options):
+    # trips are checked for connectivity while drawing instead of by duarouter.
+    # Persons may walk against the edge direction and junction taz or jtrrouter
+    # trips are not bound to the drawn edges
+    return options.validate and not options.pedestrians and not options.junctionTaz and not options.jtrrouter
+
+
+# routes trips on the already loaded network with A* on the travel time
+# (length / speed). Used instead of duarouter where possible
+
+
+class InternalRouter:
+
+    def __init__(self, net, vclass):
+        self.net = net
+        self.vclass = vclass
+        self.max_speed = max([e.getSpeed() for e in net.getEdges()] + [1])
+
+    def outgoing(self, edge):
+        if self.vclass:
+            return edge.getAllowedOutgoing(self.vclass)
+        return edge.getOutgoing()
+
+    def travel_time(self, edge):
+        return edge.getLength() / edge.getSpeed()
+
+    def route(self, edges):
+        # route along the given edges (source, vias, sink), None if unroutable
+        route = [edges[0]]
+        for source, target in zip(edges[:-1], edges[1:]):
+            leg = self.get_shortest_path(source, target)
+            if leg is None:
+                return None
+            route += leg[1:]
+        return route
+
+    def get_shortest_path(self, source, target):
+        if source == target:
+            return [source]
+        goal = target.getFromNode().getCoord()
+
+        def remaining(edge):
+            return euclidean(edge.getToNode().getCoord(), goal) / self.max_speed
+
+        costs = {source: self.travel_time(source)}
+        previous = {source: None}
+        counter = 0
+        heap = [(costs[source] + remaining(source), counter, costs[source], source)]
+        while heap:
+            _, _, cost, edge = heapq.heappop(heap)
+            if edge == target:
+                path = []
+                while edge is not None:
+                    path.append(edge)
+                    edge = previous[edge]
+                return path[::-1]
+            if cost > costs[edge]:
+                continue
+            for succ in self.outgoing(edge):
+                succ_cost = cost + self.travel_time(succ)
+                if succ_cost < costs.get(succ, float("inf")):
+                    costs[succ] = succ_cost
+                    previous[succ] = edge
+                    counter += 1
+                    heapq.heappush(heap, (succ_cost + remaining(succ), counter, succ_cost, succ))
+        return None
+
+
+def use_internal_router(options):
+    return (options.router == "internal" and not options.pedestrians and options.flows == 0 and
+            options.aggregate_flows is None and
+            not options.junctionTaz and not options.jtrrouter and options.additional is None and
+            not options.remove_loops)
+
+
+def write_internal_routes(net, options, trips, vtype_def):
+    # writes the routes of the trips generated in this run, returns the ids
+    # of the unroutable trips
+    router = InternalRouter(net, options.vclass)
+    unroutable = set()
+    with open(options.routefile, 'w') as froutes:
+        sumolib.writeXMLHeader(froutes, "$Id$", "routes")  # noqa
+        if vtype_def:
+            froutes.write(vtype_def)
+        for label, depart, edges, attrs in trips:
+            route = router.route(edges)
+            if route is None:
+                unroutable.add(label)
+                if options.verbose:
+                    print("Warning: no route for trip '%s' from '%s' to '%s'" % (
+                        label, edges[0].getID(), edges[-1].getID()), file=sys.stderr)
+                continue
+            froutes.write('    <vehicle id="%s" depart="%.2f"%s>\n' % (label, depart, attrs))
+            froutes.write('        <route edges="%s"/>\n' % ' '.join([e.getID() for e in route]))
+            froutes.write('    </vehicle>\n')
+        froutes.write("</routes>\n")
+    return unroutable
+
+
+def remove_trips(tripfile, labels):
+    # drops the (single line) trips with the given ids from the trip file
+    tmpTrips = tripfile + ".tmp"
+    tripID = re.compile(r'<trip id="([^"]*)"')
+    with open(tripfile) as fin, open(tmpTrips, 'w') as fout:
+        for line in fin:
+            match = tripID.search(line)
+            if match is None or match.group(1) not in labels:
+                fout.write(line)
+    os.remove(tripfile)  # on windows, rename does not overwrite
+    os.rename(tmpTrips, tripfile)
 
 
 def is_walk_attribute(attr):
@@ -448,11 +1188,334 @@ def prependSpace(s):
         return " " + s
 
 
+def read_net(options):
+    if options.net_cache:
+        import netcache
+        return netcache.readNet(options.netfile, verbose=options.verbose)
+    return sumolib.net.readNet(options.netfile)
+
+
+# state of the worker processes for option --jobs
+_worker_state = None
+
+
+def init_worker(options):
+    global _worker_state
+    net = read_net(options)
+    _worker_state = (buildTripGenerator(net, options), options)
+
+
+def draw_trip(trip_generator, options, depart):
+    # returns a picklable record of a trip: (depart, (source, sink, vias) or None, error)
+    try:
+        trip_generator.set_time(depart)
+        source_edge, sink_edge, intermediate = trip_generator.get_trip(
+            options.min_distance, options.max_distance, options.maxtries,
+            options.junctionTaz)
+        return depart, (source_edge.getID(), sink_edge.getID(), [e.getID() for e in intermediate]), None
+    except Exception as exc:
+        return depart, None, str(exc)
+
+
+def generate_chunk(chunk):
+    seed, departs = chunk
+    trip_generator, options = _worker_state
+    random.seed(seed)
+    trip_generator.reset()
+    sampler = trip_generator.sink_sampler
+    if sampler:
+        sampler.drawn = sampler.accepted = 0
+    records = []
+    for depart in departs:
+        if options.binomial is None:
+            records.append(draw_trip(trip_generator, options, depart))
+        else:
+            prob = 1.0 / options.period / options.binomial
+            for _ in range(options.binomial):
+                if random.random() < prob:
+                    records.append(draw_trip(trip_generator, options, depart))
+    return records, (sampler.drawn, sampler.accepted) if sampler else (0, 0)
+
+
+def generate_parallel(options, begin, end, slots=None):
+    # splits [begin, end) (or the given departure times) into one chunk of
+    # departure slots per job, each with a seed derived from the main seed,
+    # and returns the trip records of all chunks in depart order
+    if slots is None:
+        slots = []
+        depart = begin
+        while depart < end:
+            slots.append(depart)
+            depart += options.period if options.binomial is None else 1
+    base_seed = random.getrandbits(64) if options.random else options.seed
+    chunk_size = int(math.ceil(len(slots) / float(options.jobs)))
+    chunks = [(random.Random("%s:%s" % (base_seed, i)).getrandbits(64), slots[i * chunk_size:(i + 1) * chunk_size])
+              for i in range(options.jobs)]
+    pool = multiprocessing.Pool(options.jobs, init_worker, (options,))
+    try:
+        results = pool.map(generate_chunk, chunks)
+    finally:
+        pool.close()
+        pool.join()
+    records = [record for chunk_records, _ in results for record in chunk_records]
+    stats = [sum(counts) for counts in zip(*[counts for _, counts in results])]
+    return records, stats
+
+
+def aggregate_flows(options):
+    # groups the trips of the trip file by everything but their id and depart
+    # (from, to, via, attributes) and by time bucket. Groups of at least
+    # --aggregate-min trips are replaced by a flow over the bucket
+    begin = sumolib.miscutils.parseTime(options.begin)
+    end = sumolib.miscutils.parseTime(options.end)
+    size = options.aggregate_flows
+    header, elements = split_elements(options.tripfile)
+    tripAttrs = re.compile(r'<trip id="([^"]*)" depart="([^"]*)"(.*)/>')
+    definitions = []
+    groups = defaultdict(list)
+    for element in elements:
+        match = tripAttrs.search(element[0]) if len(element) == 1 else None
+        if match is None:
+            definitions.append(element)
+            continue
+        depart = float(match.group(2))
+        bucket = int((depart - begin) // size)
+        groups[(match.group(3), bucket)].append((depart, match.group(1), element))
+    timed = []
+    numFlows = 0
+    for (attrs, bucket), trips in groups.items():
+        if len(trips) < options.aggregate_min:
+            timed += trips
+            continue
+        numFlows += 1
+        flowBegin = begin + bucket * size
+        flowEnd = min(flowBegin + size, end)
+        duration = flowEnd - flowBegin
+        if options.aggregate_mode == "probability" and len(trips) <= duration:
+            amount = 'probability="%s"' % (len(trips) / duration)
+        else:
+            amount = 'number="%s"' % len(trips)
+        # named after its first trip to keep the ids unique
+        label = min(trips)[1]
+        timed.append((flowBegin, label, ['    <flow id="%s" begin="%s" end="%s" %s%s/>\n' % (
+            label, flowBegin, flowEnd, amount, attrs)]))
+    # flows start at the bucket begin and must be sorted by departure with the trips
+    timed.sort(key=lambda t: t[0])
+    with open(options.tripfile, 'w') as fout:
+        fout.writelines(header)
+        for element in definitions:
+            fout.writelines(element)
+        for _, _, element in timed:
+            fout.writelines(element)
+        fout.write("</routes>\n")
+    if options.verbose:
+        print("aggregated %s trips into %s flows" % (
+            len(elements) - len(definitions) - len(timed) + numFlows, numFlows))
+
+
+def load_demand_profile(fname):
+    # returns a list of (begin, end, vehicles per hour)
+    profile = []
+    with open(fname) as f:
+        for line in f:
+            line = line.split('#')[0].strip()
+            if line:
+                begin, end, rate = re.split(r"[\s,;]+", line)[:3]
+                profile.append((sumolib.miscutils.parseTime(begin), sumolib.miscutils.parseTime(end), float(rate)))
+    return profile
+
+
+def poisson_departures(profile, begin, end):
+    # departure times of an inhomogeneous Poisson process with the piecewise
+    # constant rates of the profile within [begin, end). Rates of overlapping
+    # intervals add up. For each interval the number of departures is Poisson
+    # distributed and the departures are uniform within the interval
+    intervals = [(max(b, begin), min(e, end), rate / 3600.) for b, e, rate in profile
+                 if min(e, end) > max(b, begin) and rate > 0]
+    if not intervals:
+        return []
+    if np is not None:
+        # seeded from the python generator to stay reproducible with --seed
+        rng = np.random.default_rng(random.getrandbits(64))
+        starts, stops, rates = np.array(intervals, dtype=float).T
+        durations = stops - starts
+        counts = rng.poisson(rates * durations)
+        departs = np.repeat(starts, counts) + rng.random(counts.sum()) * np.repeat(durations, counts)
+        departs.sort()
+        return departs.tolist()
+    departs = []
+    for start, stop, rate in intervals:
+        depart = start + random.expovariate(rate)
+        while depart < stop:
+            departs.append(depart)
+            depart += random.expovariate(rate)
+    departs.sort()
+    return departs
+
+
+def duarouter_args(options, tripfile, vtype_output=True):
+    args = [DUAROUTER, '-n', options.netfile, '-r', tripfile, '--ignore-errors',
+            '--begin', str(options.begin), '--end', str(options.end), '--no-step-log']
+    if options.additional is not None:
+        args += ['--additional-files', options.additional]
+    if options.carWalkMode is not None:
+        args += ['--persontrip.transfer.car-walk', options.carWalkMode]
+    if options.walkfactor is not None:
+        args += ['--persontrip.walkfactor', options.walkfactor]
+    if options.walkoppositefactor is not None:
+        args += ['--persontrip.walk-opposite-factor', options.walkoppositefactor]
+    if options.remove_loops:
+        args += ['--remove-loops']
+    if options.vtypeout is not None and vtype_output:
+        args += ['--vtype-output', options.vtypeout]
+    if options.junctionTaz:
+        args += ['--junction-taz']
+    if not options.verbose:
+        args += ['--no-warnings']
+    else:
+        args += ['-v']
+    return args
+
+
+def call_duarouter(options):
+    # call duarouter for routes or validated trips
+    if options.duarouter_shards > 1 and options.flows == 0 and options.aggregate_flows is None:
+        call_sharded_duarouter(options)
+        return
+    args = duarouter_args(options, options.tripfile)
+
+    if options.routefile:
+        args2 = args + ['-o', options.routefile]
+        print("calling", " ".join(args2))
+        sys.stdout.flush()
+        subprocess.call(args2)
+        sys.stdout.flush()
+
+    if options.validate and not use_reachability(options):
+        # write to temporary file because the input is read incrementally
+        tmpTrips = options.tripfile + ".tmp"
+        args2 = args + ['-o', tmpTrips, '--write-trips']
+        if options.junctionTaz:
+            args2 += ['--write-trips.junctions']
+        print("calling", " ".join(args2))
+        sys.stdout.flush()
+        subprocess.call(args2)
+        sys.stdout.flush()
+        os.remove(options.tripfile)  # on windows, rename does not overwrite
+        os.rename(tmpTrips, options.tripfile)
+
+
+def split_elements(fname):
+    # splits a route file as written by this script or by duarouter into the
+    # header (up to the root element) and the top level elements (as lists of lines)
+    header = []
+    elements = []
+    with open(fname) as f:
+        lines = iter(f)
+        for line in lines:
+            header.append(line)
+            if line.startswith("<routes"):
+                break
+        element = None
+        for line in lines:
+            stripped = line.strip()
+            if element is None:
+                if not stripped or stripped.startswith("</routes"):
+                    continue
+                element = [line]
+                tag = stripped[1:].split(None, 1)[0].rstrip("/>")
+                if stripped.endswith("/>") or stripped.startswith("<!--"):
+                    elements.append(element)
+                    element = None
+            else:
+                element.append(line)
+                if stripped == "</%s>" % tag:
+                    elements.append(element)
+                    element = None
+    return header, elements
+
+
+def get_depart(element):
+    match = re.search(r' depart="([^"]*)"', element[0])
+    return None if match is None else match.group(1)
+
+
+def alternatives_name(fname):
+    # the name duarouter chooses for its route alternatives output
+    if fname.endswith(".rou.xml"):
+        return fname[:-8] + ".rou.alt.xml"
+    if fname.endswith(".xml"):
+        return fname[:-4] + ".alt.xml"
+    return fname + ".alt"
+
+
+def merge_shards(outfile, shard_outputs):
+    # concatenates the elements of the shards (which cover consecutive time
+    # windows), definitions without depart are taken from the first shard only
+    with open(outfile, 'w') as fout:
+        for i, shard_output in enumerate(shard_outputs):
+            header, elements = split_elements(shard_output)
+            if i == 0:
+                fout.writelines(header)
+            for element in elements:
+                if i == 0 or get_depart(element) is not None:
+                    fout.writelines(element)
+        fout.write("</routes>\n")
+
+
+def call_sharded_duarouter(options):
+    header, elements = split_elements(options.tripfile)
+    definitions = [e for e in elements if get_depart(e) is None]
+    trips = [e for e in elements if get_depart(e) is not None]
+    size = max(1, int(math.ceil(len(trips) / float(options.duarouter_shards))))
+    shards = []
+    for start in range(0, max(len(trips), 1), size):
+        shard = "%s.shard%s.xml" % (options.tripfile, len(shards))
+        with open(shard, 'w') as fout:
+            fout.writelines(header)
+            for element in definitions + trips[start:start + size]:
+                fout.writelines(element)
+            fout.write("</routes>\n")
+        shards.append(shard)
+
+    def run_all(outputs, extra_args):
+        processes = []
+        for i, (shard, output) in enumerate(zip(shards, outputs)):
+            # only one process may write the vType output
+            args = duarouter_args(options, shard, i == 0) + ['-o', output] + extra_args
+            print("calling", " ".join(args))
+            sys.stdout.flush()
+            processes.append(subprocess.Popen(args))
+        for process in processes:
+            process.wait()
+        sys.stdout.flush()
+
+    temporary = list(shards)
+    if options.routefile:
+        outputs = [shard[:-4] + ".rou.xml" for shard in shards]
+        run_all(outputs, [])
+        merge_shards(options.routefile, outputs)
+        alternatives = [alternatives_name(output) for output in outputs]
+        if all([os.path.isfile(alternative) for alternative in alternatives]):
+            merge_shards(alternatives_name(options.routefile), alternatives)
+        temporary += outputs + [a for a in alternatives if os.path.isfile(a)]
+
+    if options.validate and not use_reachability(options):
+        outputs = [shard[:-4] + ".trips.xml" for shard in shards]
+        run_all(outputs, ['--write-trips', '--write-trips.junctions'] if options.junctionTaz else ['--write-trips'])
+        merge_shards(options.tripfile, outputs)
+        temporary += outputs
+
+    for fname in temporary:
+        if os.path.isfile(fname):
+            os.remove(fname)
+
+
 def main(options):
     if not options.random:
         random.seed(options.seed)
 
-    net = sumolib.net.readNet(options.netfile)
+    net = read_net(options)
     if options.min_distance > net.getBBoxDiameter() * (options.intermediate + 1):
         options.intermediate = int(
             math.ceil(options.min_distance / net.getBBoxDiameter())) - 1
@@ -471,13 +1534,20 @@ def main(options):
         options.tripattrs, options.pedestrians, options.vehicle_class)
 
     vias = {}
+    internal_routing = use_internal_router(options) and options.routefile is not None
+    routed_trips = []
+    vtype_def = None
 
-    def generate_one(idx):
+    def generate_one(idx, trip=None):
         label = "%s%s" % (options.tripprefix, idx)
         try:
-            source_edge, sink_edge, intermediate = trip_generator.get_trip(
-                options.min_distance, options.max_distance, options.maxtries,
-                options.junctionTaz)
+            if trip is None:
+                trip_generator.set_time(depart)
+                source_edge, sink_edge, intermediate = trip_generator.get_trip(
+                    options.min_distance, options.max_distance, options.maxtries,
+                    options.junctionTaz)
+            else:
+                source_edge, sink_edge, intermediate = trip
             combined_attrs = options.tripattrs
             if options.fringeattrs and source_edge.is_fringe(source_edge._incoming):
                 combined_attrs += " " + options.fringeattrs
@@ -514,6 +1584,7 @@ def main(options):
             else:
                 if options.jtrrouter:
                     attrTo = ''
+                vehicle_attrs = combined_attrs
                 combined_attrs = attrFrom + attrTo + via + combined_attrs
                 if options.flows > 0:
                     if options.binomial:
@@ -527,6 +1598,9 @@ def main(options):
                 else:
                     fouttrips.write('    <trip id="%s" depart="%.2f"%s/>\n' % (
                         label, depart, combined_attrs))
+                    if internal_routing:
+                        routed_trips.append((label, depart, [source_edge] + intermediate + [sink_edge],
+                                             vehicle_attrs))
         except Exception as exc:
             print(exc, file=sys.stderr)
         return idx + 1
@@ -549,12 +1623,34 @@ def main(options):
                     fouttype.write("</additional>\n")
             else:
                 fouttrips.write(vTypeDef)
+                vtype_def = vTypeDef
             options.tripattrs += ' type="%s"' % options.vtypeID
             personattrs += ' type="%s"' % options.vtypeID
         depart = sumolib.miscutils.parseTime(options.begin)
         maxTime = sumolib.miscutils.parseTime(options.end)
         if trip_generator:
-            if options.flows == 0:
+            departs = None
+            if options.demand_profile:
+                departs = poisson_departures(load_demand_profile(options.demand_profile), depart, maxTime)
+                if options.verbose:
+                    print("demand profile: %s departures" % len(departs))
+            if options.flows == 0 and options.jobs > 1:
+                records, (drawn, accepted) = generate_parallel(options, depart, maxTime, departs)
+                if trip_generator.sink_sampler:
+                    trip_generator.sink_sampler.drawn = drawn
+                    trip_generator.sink_sampler.accepted = accepted
+                for depart, trip, error in records:
+                    if trip is None:
+                        print(error, file=sys.stderr)
+                        idx += 1
+                    else:
+                        source, sink, intermediate = trip
+                        idx = generate_one(idx, (net.getEdge(source), net.getEdge(sink),
+                                                 [net.getEdge(e) for e in intermediate]))
+            elif departs is not None:
+                for depart in departs:
+                    idx = generate_one(idx)
+            elif options.flows == 0:
                 while depart < maxTime:
                     if options.binomial is None:
                         # generate with constant spacing
@@ -574,47 +1670,19 @@ def main(options):
 
         fouttrips.write("</routes>\n")
 
-    # call duarouter for routes or validated trips
-    args = [DUAROUTER, '-n', options.netfile, '-r', options.tripfile, '--ignore-errors',
-            '--begin', str(options.begin), '--end', str(options.end), '--no-step-log']
-    if options.additional is not None:
-        args += ['--additional-files', options.additional]
-    if options.carWalkMode is not None:
-        args += ['--persontrip.transfer.car-walk', options.carWalkMode]
-    if options.walkfactor is not None:
-        args += ['--persontrip.walkfactor', options.walkfactor]
-    if options.walkoppositefactor is not None:
-        args += ['--persontrip.walk-opposite-factor', options.walkoppositefactor]
-    if options.remove_loops:
-        args += ['--remove-loops']
-    if options.vtypeout is not None:
-        args += ['--vtype-output', options.vtypeout]
-    if options.junctionTaz:
-        args += ['--junction-taz']
-    if not options.verbose:
-        args += ['--no-warnings']
-    else:
-        args += ['-v']
+    if options.aggregate_flows is not None and trip_generator:
+        aggregate_flows(options)
 
-    if options.routefile:
-        args2 = args + ['-o', options.routefile]
-        print("calling", " ".join(args2))
-        sys.stdout.flush()
-        subprocess.call(args2)
-        sys.stdout.flush()
+    if options.verbose and trip_generator and trip_generator.sink_sampler:
+        print("stratified sink sampler: %s draws, acceptance rate %.3f" % (
+            trip_generator.sink_sampler.drawn, trip_generator.sink_sampler.acceptance_rate()))
 
-    if options.validate:
-        # write to temporary file because the input is read incrementally
-        tmpTrips = options.tripfile + ".tmp"
-        args2 = args + ['-o', tmpTrips, '--write-trips']
-        if options.junctionTaz:
-            args2 += ['--write-trips.junctions']
-        print("calling", " ".join(args2))
-        sys.stdout.flush()
-        subprocess.call(args2)
-        sys.stdout.flush()
-        os.remove(options.tripfile)  # on windows, rename does not overwrite
-        os.rename(tmpTrips, options.tripfile)
+    if internal_routing:
+        unroutable = write_internal_routes(net, options, routed_trips, vtype_def)
+        if options.validate and unroutable:
+            remove_trips(options.tripfile, unroutable)
+    else:
+        call_duarouter(options)
 
     if options.weights_outprefix:
         idPrefix = ""
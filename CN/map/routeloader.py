@@ -0,0 +1,286 @@
+"""
+Streaming columnar loader for SUMO route files (rou.xml and rou.alt.xml).
+
+The file is read with iterparse and every vehicle is cleared from the tree
+as soon as it has been converted, so memory grows with the columns only and
+not with the XML. The columns of a chunk are
+
+  ids               vehicle ids (list of str)
+  depart            float64 depart times, NaN for non-numeric departs
+  vehicle_offsets   int64, the routes of vehicle i are
+                    routes[vehicle_offsets[i]:vehicle_offsets[i + 1]]
+  route_offsets     int64, the edges of route j are
+                    edges[route_offsets[j]:route_offsets[j + 1]]
+  edges             int32 edge indices (see routestore.EdgeIndex)
+  cost, probability float64 per route, NaN where the file has none
+  chosen            int64 per vehicle, the route used by the vehicle (the
+                    "last" attribute of a routeDistribution)
+
+A plain rou.xml gives one route per vehicle. Vehicles referring to a named
+route get a copy of its edges. Files larger than memory are processed with
+iter_chunks, which yields the columns of at most chunk_size vehicles at a
+time, or from the command line, which writes one .npz file per chunk:
+
+  python routeloader.py nycmap.rou.alt.xml -n nycmap.net.xml -o alt
+"""
+
+from __future__ import print_function
+from __future__ import absolute_import
+import argparse
+import math
+import xml.etree.ElementTree as ET
+
+import numpy as np
+
+from routestore import EdgeIndex, RouteStore
+
+DEFAULT_CHUNK_SIZE = 100000
+
+
+def _float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return math.nan
+
+
+class RouteColumns:
+    """the routes of a chunk of vehicles as flat arrays"""
+
+    def __init__(self, ids, depart, vehicle_offsets, route_offsets, edges, cost, probability, chosen):
+        self.ids = ids
+        self.depart = depart
+        self.vehicle_offsets = vehicle_offsets
+        self.route_offsets = route_offsets
+        self.edges = edges
+        self.cost = cost
+        self.probability = probability
+        self.chosen = chosen
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def num_routes(self):
+        return len(self.route_offsets) - 1
+
+    def route(self, j):
+        return self.edges[self.route_offsets[j]:self.route_offsets[j + 1]]
+
+    def alternatives(self, i):
+        """indices of the routes of vehicle i"""
+        return np.arange(self.vehicle_offsets[i], self.vehicle_offsets[i + 1])
+
+    def chosen_routes(self):
+        """the route used by each vehicle, e.g. to compare against ACO routes"""
+        store = RouteStore(capacity=max(1, len(self.edges)))
+        for j in self.chosen.tolist():
+            store.append(self.route(j) if j >= 0 else ())
+        return store
+
+    def save(self, fname):
+        np.savez(fname, ids=np.array(self.ids), depart=self.depart, vehicle_offsets=self.vehicle_offsets,
+                 route_offsets=self.route_offsets, edges=self.edges, cost=self.cost,
+                 probability=self.probability, chosen=self.chosen)
+
+    @classmethod
+    def load(cls, fname):
+        with np.load(fname) as data:
+            return cls(data["ids"].tolist(), data["depart"], data["vehicle_offsets"], data["route_offsets"],
+                       data["edges"], data["cost"], data["probability"], data["chosen"])
+
+    @classmethod
+    def concatenate(cls, chunks):
+        chunks = list(chunks)
+        ids = []
+        for chunk in chunks:
+            ids.extend(chunk.ids)
+
+        def offsets(name, lengths):
+            parts = [np.zeros(1, dtype=np.int64)]
+            base = 0
+            for chunk, length in zip(chunks, lengths):
+                parts.append(getattr(chunk, name)[1:] + base)
+                base += length
+            return np.concatenate(parts)
+
+        num_routes = [c.num_routes for c in chunks]
+        route_base = np.cumsum([0] + num_routes[:-1]).tolist()
+        chosen = [np.where(c.chosen >= 0, c.chosen + base, -1) for c, base in zip(chunks, route_base)]
+        return cls(ids,
+                   np.concatenate([c.depart for c in chunks] or [np.zeros(0)]),
+                   offsets("vehicle_offsets", num_routes),
+                   offsets("route_offsets", [len(c.edges) for c in chunks]),
+                   np.concatenate([c.edges for c in chunks] or [np.zeros(0, dtype=np.int32)]),
+                   np.concatenate([c.cost for c in chunks] or [np.zeros(0)]),
+                   np.concatenate([c.probability for c in chunks] or [np.zeros(0)]),
+                   np.concatenate(chosen or [np.zeros(0, dtype=np.int64)]))
+
+
+class _ChunkBuilder:
+
+    def __init__(self):
+        self.ids = []
+        self.depart = []
+        self.vehicle_offsets = [0]
+        self.route_offsets = [0]
+        self.edges = []
+        self.cost = []
+        self.probability = []
+        self.chosen = []
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add_vehicle(self, vehicle_id, depart, routes, chosen):
+        """routes is a list of (edge index array, cost, probability)"""
+        first = len(self.cost)
+        for edges, cost, probability in routes:
+            self.edges.append(edges)
+            self.route_offsets.append(self.route_offsets[-1] + len(edges))
+            self.cost.append(cost)
+            self.probability.append(probability)
+        self.ids.append(vehicle_id)
+        self.depart.append(depart)
+        self.vehicle_offsets.append(len(self.cost))
+        self.chosen.append(first + chosen if 0 <= chosen < len(routes) else -1)
+
+    def build(self):
+        return RouteColumns(self.ids,
+                            np.array(self.depart, dtype=np.float64),
+                            np.array(self.vehicle_offsets, dtype=np.int64),
+                            np.array(self.route_offsets, dtype=np.int64),
+                            np.concatenate(self.edges) if self.edges else np.zeros(0, dtype=np.int32),
+                            np.array(self.cost, dtype=np.float64),
+                            np.array(self.probability, dtype=np.float64),
+                            np.array(self.chosen, dtype=np.int64))
+
+
+def iter_chunks(fname, edge_index=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """yields RouteColumns of at most chunk_size vehicles each. Without
+    edge_index, a new EdgeIndex numbering the edges in order of appearance is
+    used; pass the same one to the loads of files to be compared"""
+    if edge_index is None:
+        edge_index = EdgeIndex()
+    named_routes = {}
+    builder = _ChunkBuilder()
+    root = None
+    depth = 0
+    routes = []
+    last = -1
+    for event, elem in ET.iterparse(fname, events=("start", "end")):
+        if event == "start":
+            if root is None:
+                root = elem
+            depth += 1
+            continue
+        depth -= 1
+        tag = elem.tag
+        if tag == "route":
+            edges = edge_index.encode(elem.get("edges", "").split())
+            if depth == 1:
+                # named route definition at top level
+                named_routes[elem.get("id")] = edges
+            else:
+                routes.append((edges, _float(elem.get("cost")), _float(elem.get("probability"))))
+        elif tag == "routeDistribution" and depth > 1:
+            last = int(elem.get("last", len(routes) - 1))
+        elif tag == "vehicle" and depth == 1:
+            if not routes and elem.get("route") in named_routes:
+                routes.append((named_routes[elem.get("route")], math.nan, math.nan))
+            builder.add_vehicle(elem.get("id"), _float(elem.get("depart")), routes,
+                                last if last >= 0 else len(routes) - 1)
+            routes = []
+            last = -1
+            if len(builder) >= chunk_size:
+                yield builder.build()
+                builder = _ChunkBuilder()
+        if depth == 1:
+            # everything below the root has been converted
+            root.clear()
+    if len(builder) > 0:
+        yield builder.build()
+
+
+def load(fname, edge_index=None):
+    """all vehicles of the file as one RouteColumns"""
+    return RouteColumns.concatenate(iter_chunks(fname, edge_index))
+
+
+def route_weights(chunk):
+    """pheromone deposit of each route: probability / cost. Routes without
+    probability count as 1, routes without cost use their number of edges"""
+    probability = np.where(np.isnan(chunk.probability), 1.0, chunk.probability)
+    cost = np.where(np.isnan(chunk.cost), np.diff(chunk.route_offsets), chunk.cost)
+    return probability / np.maximum(cost, 1e-9)
+
+
+def edge_deposits(fname, edge_index, chunk_size=DEFAULT_CHUNK_SIZE):
+    """sum of the route weights per edge index, streamed from a route file"""
+    total = np.zeros(len(edge_index))
+    for chunk in iter_chunks(fname, edge_index, chunk_size):
+        weights = np.repeat(route_weights(chunk), np.diff(chunk.route_offsets))
+        deposits = np.bincount(chunk.edges, weights=weights, minlength=len(edge_index))
+        total = np.concatenate([total, np.zeros(len(deposits) - len(total))]) + deposits
+    return total
+
+
+def transition_deposits(fname, edge_index, chunk_size=DEFAULT_CHUNK_SIZE):
+    """sum of the route weights per pair of consecutive edge indices"""
+    total = {}
+    for chunk in iter_chunks(fname, edge_index, chunk_size):
+        weights = np.repeat(route_weights(chunk), np.diff(chunk.route_offsets))
+        # drop the pairs spanning two routes
+        keep = np.ones(len(chunk.edges) - 1 if len(chunk.edges) else 0, dtype=bool)
+        ends = chunk.route_offsets[1:-1] - 1
+        keep[ends[(ends >= 0) & (ends < len(keep))]] = False
+        keys = (chunk.edges[:-1].astype(np.int64) << 32 | chunk.edges[1:])[keep]
+        unique, inverse = np.unique(keys, return_inverse=True)
+        deposits = np.bincount(inverse, weights=weights[:-1][keep], minlength=len(unique))
+        for key, deposit in zip(unique.tolist(), deposits.tolist()):
+            pair = (key >> 32, key & 0xFFFFFFFF)
+            total[pair] = total.get(pair, 0.0) + deposit
+    return total
+
+
+def pheromone_levels(deposits, base, min_pheromone, max_pheromone):
+    """scales deposits so that the largest one reaches max_pheromone on top
+    of the base level, bounded by min_pheromone and max_pheromone"""
+    deposits = np.asarray(deposits, dtype=np.float64)
+    peak = deposits.max() if len(deposits) else 0.0
+    if peak <= 0:
+        return np.full(len(deposits), base)
+    return np.clip(base + (max_pheromone - base) * deposits / peak, min_pheromone, max_pheromone)
+
+
+def get_options(args=None):
+    parser = argparse.ArgumentParser(description="Convert SUMO route files to columnar .npz chunks")
+    parser.add_argument("route_file", help="rou.xml or rou.alt.xml file")
+    parser.add_argument("-n", "--net-file", dest="netfile",
+                        help="number the edges as in this network (default: in order of appearance)")
+    parser.add_argument("-o", "--output-prefix", dest="prefix", default="routes",
+                        help="chunks are written to PREFIX.00000.npz, ... and the edge ids to PREFIX.edges.txt")
+    parser.add_argument("-c", "--chunk-size", dest="chunk_size", type=int, default=DEFAULT_CHUNK_SIZE,
+                        help="number of vehicles per chunk")
+    return parser.parse_args(args=args)
+
+
+def main(options):
+    if options.netfile:
+        import netcache
+        edge_index = EdgeIndex(netcache.readNet(options.netfile))
+    else:
+        edge_index = EdgeIndex()
+    vehicles = routes = 0
+    for i, chunk in enumerate(iter_chunks(options.route_file, edge_index, options.chunk_size)):
+        chunk.save("%s.%05d.npz" % (options.prefix, i))
+        vehicles += len(chunk)
+        routes += chunk.num_routes
+    with open(options.prefix + ".edges.txt", "w") as f:
+        for id in edge_index.ids:
+            f.write(id + "\n")
+    print("converted %s vehicles with %s routes" % (vehicles, routes))
+
+
+if __name__ == "__main__":
+    main(get_options())
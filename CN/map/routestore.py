@@ -0,0 +1,215 @@
+"""
+Compact integer representation of routes.
+
+A route is an int32 numpy array of edge indices instead of a list of edge
+ID strings. EdgeIndex translates between both and is only needed at the
+boundaries (TraCI calls, output files). RouteStore keeps the routes of a
+whole fleet in two flat arrays, the concatenated edge indices and the
+offsets where each route starts, so that per-route sums such as lengths or
+costs are computed vectorized. RouteTrie stores each shared route prefix
+once and writes identical routes as one named route definition. A trie node
+costs a dict entry and three ints against 4 bytes per edge in RouteStore, so
+the trie only saves memory when most edges are shared (dense demand from few
+origins); otherwise it is an output deduplication.
+"""
+
+from __future__ import print_function
+from __future__ import absolute_import
+
+from array import array
+
+import numpy as np
+
+
+class EdgeIndex:
+    """numbers the edges of a net in the order of net.getEdges(). Without a
+    net, ids (e.g. CAMOACO nodes) are numbered in the order of first use"""
+
+    def __init__(self, net=None):
+        self.ids = []
+        self.index = {}
+        self.lengths = None
+        self.frozen = net is not None
+        if net is not None:
+            edges = net.getEdges()
+            self.ids = [e.getID() for e in edges]
+            self.index = dict([(id, i) for i, id in enumerate(self.ids)])
+            arrays = getattr(net, "arrays", None)
+            if arrays is not None:
+                self.lengths = np.asarray(arrays["edge_length"], dtype=np.float64)
+            else:
+                self.lengths = np.array([e.getLength() for e in edges], dtype=np.float64)
+
+    def get(self, id):
+        i = self.index.get(id)
+        if i is None:
+            if self.frozen:
+                raise KeyError(id)
+            i = self.index[id] = len(self.ids)
+            self.ids.append(id)
+        return i
+
+    def encode(self, ids):
+        return np.array([self.get(id) for id in ids], dtype=np.int32)
+
+    def decode(self, route):
+        ids = self.ids
+        return [ids[i] for i in route.tolist()]
+
+    def __len__(self):
+        return len(self.ids)
+
+
+class RouteStore:
+    """ragged array of routes: route i is values[offsets[i]:offsets[i + 1]]"""
+
+    def __init__(self, capacity=1024):
+        self._values = np.empty(capacity, dtype=np.int32)
+        self._offsets = np.zeros(64, dtype=np.int64)
+        self._count = 0
+
+    @property
+    def values(self):
+        return self._values[:self._offsets[self._count]]
+
+    @property
+    def offsets(self):
+        return self._offsets[:self._count + 1]
+
+    def append(self, route):
+        """adds a route (array or sequence of edge indices) and returns its number"""
+        route = np.asarray(route, dtype=np.int32)
+        start = self._offsets[self._count]
+        end = start + len(route)
+        if end > len(self._values):
+            self._values = np.resize(self._values, max(end, 2 * len(self._values)))
+        if self._count + 2 > len(self._offsets):
+            self._offsets = np.resize(self._offsets, 2 * len(self._offsets))
+        self._values[start:end] = route
+        self._count += 1
+        self._offsets[self._count] = end
+        return self._count - 1
+
+    def extend(self, routes):
+        for route in routes:
+            self.append(route)
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self._count
+        if not 0 <= i < self._count:
+            raise IndexError(i)
+        return self._values[self._offsets[i]:self._offsets[i + 1]]
+
+    def __iter__(self):
+        for i in range(self._count):
+            yield self._values[self._offsets[i]:self._offsets[i + 1]]
+
+    def route_lengths(self):
+        """number of edges per route"""
+        return np.diff(self.offsets)
+
+    def route_sums(self, edge_values):
+        """sum of edge_values (e.g. EdgeIndex.lengths) over the edges of each route"""
+        cumulative = np.concatenate([[0.0], np.cumsum(np.asarray(edge_values)[self.values])])
+        offsets = self.offsets
+        return cumulative[offsets[1:]] - cumulative[offsets[:-1]]
+
+    def to_ids(self, i, edge_index):
+        return edge_index.decode(self[i])
+
+    def write_route(self, outf, i, edge_index, indent="        "):
+        """writes route i as inline <route> element (e.g. within a <vehicle>),
+        nothing for an empty route, which SUMO would reject"""
+        if len(self[i]):
+            outf.write('%s<route edges="%s"/>\n' % (indent, ' '.join(self.to_ids(i, edge_index))))
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes + self.offsets.nbytes
+
+
+class RouteTrie:
+    """routes sharing a prefix share the trie nodes of that prefix. Node 0 is
+    the root, every other node stands for the edge leading to it, so a route
+    is identified by the node of its last edge"""
+
+    def __init__(self):
+        self._children = {}  # (node << 32) | edge -> child node
+        self._parent = array('i', [-1])
+        self._edge = array('i', [-1])
+        self._count = array('i', [0])  # routes ending in the node
+        self.inserted = 0
+        self.inserted_edges = 0
+
+    def insert(self, route):
+        """adds a route (sequence of edge indices) and returns the node identifying
+        it. Empty routes are not stored, they return None"""
+        route = np.asarray(route, dtype=np.int32)
+        if len(route) == 0:
+            return None
+        node = 0
+        children = self._children
+        for edge in route.tolist():
+            key = (node << 32) | edge
+            child = children.get(key)
+            if child is None:
+                child = children[key] = len(self._parent)
+                self._parent.append(node)
+                self._edge.append(edge)
+                self._count.append(0)
+            node = child
+        self._count[node] += 1
+        self.inserted += 1
+        self.inserted_edges += len(route)
+        return node
+
+    def route(self, node):
+        edges = []
+        while node > 0:
+            edges.append(self._edge[node])
+            node = self._parent[node]
+        return np.array(edges[::-1], dtype=np.int32)
+
+    def count(self, node):
+        return self._count[node]
+
+    def edges(self, node, edge_index):
+        """the route of node as edges attribute value of a <route> element"""
+        return ' '.join(edge_index.decode(self.route(node)))
+
+    def __len__(self):
+        """number of distinct routes"""
+        return sum(1 for c in self._count if c > 0)
+
+    def __iter__(self):
+        """yields (node, route, count) for the distinct routes in insertion order of their last edge"""
+        for node, count in enumerate(self._count):
+            if count > 0:
+                yield node, self.route(node), count
+
+    def stats(self):
+        nodes = len(self._parent) - 1
+        return {"routes": self.inserted,
+                "distinct": len(self),
+                "edges": self.inserted_edges,
+                "nodes": nodes,
+                "sharing": 1 - float(nodes) / self.inserted_edges if self.inserted_edges else 0.0}
+
+    def write_routes(self, outf, edge_index, prefix="r", indent="    "):
+        """writes a named <route id="..."> definition for every distinct route
+        and returns the ids by node, to be referenced by vehicles"""
+        ids = {}
+        for node, route, _ in self:
+            ids[node] = "%s%s" % (prefix, node)
+            outf.write('%s<route id="%s" edges="%s"/>\n' % (indent, ids[node], ' '.join(edge_index.decode(route))))
+        return ids
+
+    def write_route(self, outf, node, edge_index, indent="        "):
+        """writes the route of node as inline <route> element (e.g. within a
+        <vehicle>), nothing for the root or None"""
+        if node:
+            outf.write('%s<route edges="%s"/>\n' % (indent, self.edges(node, edge_index)))
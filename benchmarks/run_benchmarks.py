@@ -0,0 +1,245 @@
+"""Offline benchmarks for trip generation and both ACO engines.
+
+Usage:
+    python benchmarks/run_benchmarks.py run [-o results.json] [--quick]
+    python benchmarks/run_benchmarks.py compare baseline.json results.json [--threshold 0.1]
+
+``run`` times the hot paths on the bundled ``nycmap.net.xml`` with a stub
+in place of the TraCI server and writes the per-call timings as JSON.
+``compare`` reports the ratio of the median timings against a saved
+baseline and exits with status 1 if any benchmark got slower than the
+threshold allows.
+"""
+import argparse
+import importlib.util
+import json
+import logging
+import math
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+from typing import Callable, Dict, List
+
+from traci_stub import TraCIStub
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_NET = os.path.join(REPO_ROOT, "CN", "map", "nycmap.net.xml")
+COLONY_SIZES = (5, 10, 20, 40)
+
+
+def load_module(name: str, path: str):
+    """Load a module from a file path.
+
+    Both ACO engines live in modules named ``acoTrips``, so they cannot be
+    imported side by side by name. The directory of the module is put on
+    ``sys.path`` for its own imports (e.g. ``netcache``).
+    """
+    directory = os.path.dirname(path)
+    if directory not in sys.path:
+        sys.path.insert(0, directory)
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def time_call(func: Callable[[], object], number: int, repeat: int, batch: int = 1) -> Dict[str, float]:
+    """Time ``number`` calls of func, ``repeat`` times.
+
+    Timings are in seconds per operation, where one call of func performs
+    ``batch`` operations.
+    """
+    func()  # warm up caches
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        samples.append((time.perf_counter() - start) / number / batch)
+    return {
+        "median": statistics.median(samples),
+        "min": min(samples),
+        "mean": statistics.mean(samples),
+        "stdev": statistics.stdev(samples) if len(samples) > 1 else 0.0,
+        "number": number,
+        "repeat": repeat,
+    }
+
+
+def make_camoaco_class(base):
+    """CAMOACO with the metric hooks filled in from the network junctions."""
+
+    class BenchCAMOACO(base):
+        def __init__(self, net, nodes, **kwargs):
+            super().__init__(**kwargs)
+            self.coords = {node.getID(): node.getCoord()[:2] for node in nodes}
+            self.heuristic = {node_id: None for node_id in self.coords}
+            self.max_speed = max(edge.getSpeed() for edge in net.getEdges())
+
+        def get_distance(self, node1, node2):
+            (x1, y1), (x2, y2) = self.coords[node1], self.coords[node2]
+            return math.hypot(x1 - x2, y1 - y2)
+
+        def get_travel_time(self, node1, node2):
+            return self.get_distance(node1, node2) / self.max_speed
+
+        def get_congestion(self, node):
+            # stable stand-in for a congestion level
+            return len(node) % 7
+
+    return BenchCAMOACO
+
+
+def run_benchmarks(net_file: str, quick: bool = False) -> Dict[str, Dict[str, float]]:
+    repeat = 3 if quick else 7
+    scale = 0.2 if quick else 1.0
+
+    def n(count: int) -> int:
+        return max(1, int(count * scale))
+
+    random_trips = load_module("bench_randomTrips", os.path.join(REPO_ROOT, "CN", "map", "randomTrips.py"))
+    camo = load_module("bench_camoaco", os.path.join(REPO_ROOT, "CN", "map", "acoTrips.py"))
+    vanet = load_module("bench_vanetaco", os.path.join(REPO_ROOT, "workspace.omnetpp", "CN", "acoTrips.py"))
+    logging.getLogger().setLevel(logging.WARNING)
+
+    net = vanet.sumolib.net.readNet(net_file)
+    stub = TraCIStub(net)
+    vanet.traci = stub
+    results = {}
+
+    # randomTrips
+    options = random_trips.get_options(["-n", net_file])
+    random.seed(options.seed)
+    trip_generator = random_trips.buildTripGenerator(net, options)
+    results["randomtrips.RandomEdgeGenerator.get"] = time_call(
+        trip_generator.source_generator.get, n(20000), repeat)
+    results["randomtrips.RandomTripGenerator.get_trip"] = time_call(
+        lambda: trip_generator.get_trip(options.min_distance, options.max_distance, options.maxtries),
+        n(5000), repeat)
+
+    # VANETACO
+    random.seed(42)
+    aco = vanet.VANETACO(net)
+    edge_ids = [edge.getID() for edge in net.getEdges()]
+    pairs = [(random.choice(edge_ids), random.choice(edge_ids)) for _ in range(64)]
+    routes = [aco.select_route(start, dest) for start, dest in pairs[:8]]
+    route = max(routes, key=len)
+
+    # A few sampling rounds, so that update_pheromones reads the temporal
+    # variance of the metric history and not the fallback for a fresh history
+    for _ in range(3):
+        aco.calculate_route_quality(route)
+        aco.metrics.next_step()
+    if aco._calculate_network_dynamics(route) <= 0:
+        raise RuntimeError("network dynamics stayed 0 after several sampling rounds")
+
+    def select_routes():
+        # the same walks on every call
+        random.seed(42)
+        for start, dest in pairs:
+            aco.select_route(start, dest)
+
+    results["vanetaco.select_route"] = time_call(select_routes, n(5), repeat, len(pairs))
+    results["vanetaco.update_pheromones"] = time_call(lambda: aco.update_pheromones(route, 0.01), n(200), repeat)
+    results["vanetaco.calculate_route_quality"] = time_call(
+        lambda: aco.calculate_route_quality(route), n(200), repeat)
+
+    # CAMOACO on a complete graph of junctions, as in the TraCI loop
+    bench_class = make_camoaco_class(camo.CAMOACO)
+    nodes = random.Random(1).sample(net.getNodes(), 30)
+    start, end = nodes[0].getID(), nodes[-1].getID()
+    for num_ants in COLONY_SIZES:
+        colony = bench_class(net, nodes, num_ants=num_ants, alpha=1, beta=2, rho=0.5, q0=0.8,
+                             max_iterations=5)
+
+        def run_colony():
+            # the same walks on every call
+            random.seed(42)
+            return colony.run(start, end)
+
+        results[f"camoaco.run[ants={num_ants}]"] = time_call(run_colony, 1, repeat)
+
+    # ReroutingScheduler: a large change of route cost outranks proximity
+    rerouting = load_module("bench_rerouting", os.path.join(REPO_ROOT, "CN", "map", "rerouting.py"))
+    order = []
+    rerouting.ReroutingScheduler(budget_ms=1000).run(0, [("near", 0.0, 0.0), ("far", 1000.0, 5.0)], order.append)
+    if order != ["far", "near"]:
+        raise RuntimeError(f"route cost change does not order the rerouting: {order}")
+    rng = random.Random(1)
+    candidates = [(f"veh{i}", rng.uniform(0, 500), rng.uniform(0, 1)) for i in range(1000)]
+    results["rerouting.ReroutingScheduler.run[1000]"] = time_call(
+        lambda: rerouting.ReroutingScheduler(budget_ms=1000).run(0, candidates, lambda vehicle_id: None),
+        n(50), repeat)
+    return results
+
+
+def run(args) -> int:
+    started = time.time()
+    results = run_benchmarks(args.net, args.quick)
+    report = {
+        "meta": {
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(started)),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "net": os.path.relpath(args.net, REPO_ROOT),
+            "quick": args.quick,
+        },
+        "benchmarks": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    for name, timing in sorted(results.items()):
+        print(f"{name:45s} {timing['median'] * 1e6:12.1f} us")
+    print(f"wrote {args.output}")
+    return 0
+
+
+def compare(args) -> int:
+    with open(args.baseline) as f:
+        baseline = json.load(f)["benchmarks"]
+    with open(args.current) as f:
+        current = json.load(f)["benchmarks"]
+    regressions: List[str] = []
+    print(f"{'benchmark':45s} {'baseline':>12s} {'current':>12s} {'ratio':>7s}")
+    for name in sorted(set(baseline) | set(current)):
+        if name not in baseline or name not in current:
+            print(f"{name:45s} {'only in ' + ('current' if name in current else 'baseline'):>33s}")
+            continue
+        old, new = baseline[name]["median"], current[name]["median"]
+        ratio = new / old if old > 0 else float("inf")
+        flag = ""
+        if ratio > 1 + args.threshold:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        elif ratio < 1 - args.threshold:
+            flag = "  faster"
+        print(f"{name:45s} {old * 1e6:10.1f}us {new * 1e6:10.1f}us {ratio:7.2f}{flag}")
+    if regressions:
+        print(f"{len(regressions)} regression(s) above {args.threshold:.0%}")
+        return 1
+    return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Offline benchmarks for trip generation and the ACO engines")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="run the benchmarks and write the timings as JSON")
+    run_parser.add_argument("-o", "--output", default="benchmark_results.json", help="JSON output file")
+    run_parser.add_argument("-n", "--net", default=DEFAULT_NET, help="SUMO network (default: bundled nycmap)")
+    run_parser.add_argument("--quick", action="store_true", help="fewer calls and repetitions")
+    run_parser.set_defaults(func=run)
+    compare_parser = commands.add_parser("compare", help="compare timings against a saved baseline")
+    compare_parser.add_argument("baseline", help="JSON file of an earlier run")
+    compare_parser.add_argument("current", help="JSON file of the run to check")
+    compare_parser.add_argument("--threshold", type=float, default=0.1,
+                                help="relative slowdown of the median reported as regression (default 0.1)")
+    compare_parser.set_defaults(func=compare)
+    args = parser.parse_args()
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,155 @@
+"""Time and memory of trip generation and VANET-ACO routing versus network size.
+
+Usage:
+    python benchmarks/scaling.py [--kinds grid radial planar] [--sizes 1000 10000 100000]
+                                 [--no-memory] [-o scaling.json] [--plot scaling.png]
+
+For every synthetic network (see synthetic_net.py) the harness measures
+building the RandomTripGenerator, drawing trips with it and
+VANETACO.select_route on synthetic vehicle states (traci_stub.py). Memory is
+the peak traced by tracemalloc in a separate pass, so that tracing does not
+distort the timings; --no-memory skips that pass and halves the run time.
+Plotting requires matplotlib.
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Optional, Tuple
+
+from run_benchmarks import REPO_ROOT, load_module
+from synthetic_net import KINDS, build_net
+from traci_stub import TraCIStub
+
+
+def measure(func: Callable[[], object], memory: bool = True) -> Tuple[float, Optional[float], object]:
+    """Returns the seconds taken by func, its peak traced memory in MB (None
+    without the memory pass) and its result."""
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    if not memory:
+        return elapsed, None, result
+    del result
+    tracemalloc.start()
+    result = func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak / 1e6, result
+
+
+def per_call(func: Callable[[], object], calls: int) -> float:
+    """Seconds per call of func."""
+    start = time.perf_counter()
+    for _ in range(calls):
+        func()
+    return (time.perf_counter() - start) / calls
+
+
+def scale_point(random_trips, vanet, kind: str, size: int, trips: int, routes: int,
+                memory: bool = True) -> Dict[str, float]:
+    net_s, net_mb, net = measure(lambda: build_net(kind, size), memory)
+    point = {"kind": kind, "target_edges": size, "edges": len(net.getEdges()),
+             "build_net_s": net_s, "net_mb": net_mb}
+
+    options = random_trips.get_options(["-n", "%s%s.net.xml" % (kind, size)])
+    random.seed(options.seed)
+    point["trip_generator_build_s"], point["trip_generator_mb"], trip_generator = measure(
+        lambda: random_trips.buildTripGenerator(net, options), memory)
+    point["get_trip_s"] = per_call(
+        lambda: trip_generator.get_trip(options.min_distance, options.max_distance, options.maxtries), trips)
+
+    point["vehicle_states_s"], point["vehicle_states_mb"], stub = measure(lambda: TraCIStub(net), memory)
+    vanet.traci = stub
+    aco = vanet.VANETACO(net)
+    edge_ids = [edge.getID() for edge in net.getEdges()]
+    pairs = [(random.choice(edge_ids), random.choice(edge_ids)) for _ in range(routes)]
+
+    def select_routes():
+        random.seed(42)
+        return [aco.select_route(start, dest) for start, dest in pairs]
+
+    select_s, point["select_route_mb"], _ = measure(select_routes, memory)
+    point["select_route_s"] = select_s / routes
+    return point
+
+
+def plot(points: List[Dict[str, float]], fname: str):
+    try:
+        import matplotlib
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
+    except ImportError:
+        print("Error: plotting requires matplotlib", file=sys.stderr)
+        return
+    memory = all(p["trip_generator_mb"] is not None for p in points)
+    if memory:
+        fig, (ax_time, ax_memory) = plt.subplots(1, 2, figsize=(12, 5))
+    else:
+        fig, ax_time = plt.subplots(1, 1, figsize=(6, 5))
+    for kind in sorted(set(p["kind"] for p in points)):
+        series = sorted([p for p in points if p["kind"] == kind], key=lambda p: p["edges"])
+        edges = [p["edges"] for p in series]
+        ax_time.plot(edges, [p["get_trip_s"] * 1e6 for p in series], "o-", label="get_trip (%s)" % kind)
+        ax_time.plot(edges, [p["select_route_s"] * 1e6 for p in series], "s--", label="select_route (%s)" % kind)
+        if memory:
+            ax_memory.plot(edges, [p["trip_generator_mb"] for p in series], "o-",
+                           label="RandomTripGenerator (%s)" % kind)
+            ax_memory.plot(edges, [p["select_route_mb"] + p["vehicle_states_mb"] for p in series], "s--",
+                           label="select_route + vehicle states (%s)" % kind)
+    ax_time.set_ylabel("time per call [us]")
+    axes = [ax_time]
+    if memory:
+        ax_memory.set_ylabel("peak memory [MB]")
+        axes.append(ax_memory)
+    for ax in axes:
+        ax.set_xscale("log")
+        ax.set_yscale("log")
+        ax.set_xlabel("edges")
+        ax.grid(True, which="both", alpha=0.3)
+        ax.legend(fontsize="small")
+    fig.tight_layout()
+    fig.savefig(fname)
+    print("wrote %s" % fname)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Scaling of trip generation and VANET-ACO with network size")
+    parser.add_argument("--kinds", nargs="+", choices=KINDS, default=list(KINDS))
+    parser.add_argument("--sizes", nargs="+", type=int, default=[1000, 10000, 100000],
+                        help="target numbers of edges (up to 10^6)")
+    parser.add_argument("--trips", type=int, default=2000, help="trips drawn per network")
+    parser.add_argument("--routes", type=int, default=20, help="routes selected per network")
+    parser.add_argument("--no-memory", dest="memory", action="store_false",
+                        help="skip the tracemalloc pass, which runs every workload a second time")
+    parser.add_argument("-o", "--output", default="scaling.json", help="JSON output file")
+    parser.add_argument("--plot", help="write a plot of time and memory versus size to this file")
+    args = parser.parse_args()
+
+    random_trips = load_module("bench_randomTrips", os.path.join(REPO_ROOT, "CN", "map", "randomTrips.py"))
+    vanet = load_module("bench_vanetaco", os.path.join(REPO_ROOT, "workspace.omnetpp", "CN", "acoTrips.py"))
+    logging.getLogger().setLevel(logging.WARNING)
+
+    points = []
+    for kind in args.kinds:
+        for size in args.sizes:
+            point = scale_point(random_trips, vanet, kind, size, args.trips, args.routes, args.memory)
+            points.append(point)
+            line = "%-7s %8d edges  get_trip %8.1f us  select_route %10.1f us" % (
+                kind, point["edges"], point["get_trip_s"] * 1e6, point["select_route_s"] * 1e6)
+            if args.memory:
+                line += "  generator %8.1f MB" % point["trip_generator_mb"]
+            print(line)
+    with open(args.output, "w") as f:
+        json.dump(points, f, indent=2)
+    if args.plot:
+        plot(points, args.plot)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,227 @@
+"""Synthetic road networks for scaling studies.
+
+Builds grid, radial and random planar networks of a requested size (in
+edges) directly as ``netcache.CompiledNet`` objects, which offer the part of
+the sumolib.net API used by randomTrips.py and acoTrips.py without parsing
+any XML. Minor streets are one-way with a given probability, arterials are
+always two-way, and every street gets one of the speed classes below.
+
+The networks can also be written as plain node and edge files for
+netconvert, which turns them into SUMO networks:
+
+    python benchmarks/synthetic_net.py grid 10000 -o grid10k --netconvert
+"""
+import argparse
+import math
+import os
+import subprocess
+import sys
+from typing import Tuple
+
+import numpy as np
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_ROOT, "CN", "map"))
+import netcache  # noqa
+
+# (SUMO type, speed in m/s, lanes); the speeds follow the NYC limits
+SPEED_CLASSES = [
+    ("highway.residential", 11.18, 1),
+    ("highway.secondary", 13.89, 2),
+    ("highway.primary", 16.67, 3),
+    ("highway.motorway", 24.59, 3),
+]
+RESIDENTIAL, SECONDARY, PRIMARY, MOTORWAY = range(len(SPEED_CLASSES))
+KINDS = ("grid", "radial", "planar")
+
+
+def _edges_per_street(oneway_ratio: float) -> float:
+    # estimate for sizing, about 80% of the streets are minor streets which may be one-way
+    return 2 - 0.8 * oneway_ratio
+
+
+def grid_streets(target_edges: int, oneway_ratio: float, rng: np.random.Generator,
+                 spacing: float = 100.0):
+    """Manhattan-like grid; every 5th avenue is secondary, every 10th primary."""
+    streets = target_edges / _edges_per_street(oneway_ratio)
+    n = max(2, int(round(0.5 + math.sqrt(0.25 + streets / 2))))
+    index = np.arange(n * n).reshape(n, n)
+    x, y = np.meshgrid(np.arange(n) * spacing, np.arange(n) * spacing)
+    a = np.concatenate([index[:, :-1].ravel(), index[:-1, :].ravel()])
+    b = np.concatenate([index[:, 1:].ravel(), index[1:, :].ravel()])
+    # the row of each horizontal and the column of each vertical street
+    line = np.concatenate([np.repeat(np.arange(n), n - 1), np.tile(np.arange(n), n - 1)])
+    street_class = np.where(line % 10 == 0, PRIMARY, np.where(line % 5 == 0, SECONDARY, RESIDENTIAL))
+    return x.ravel().astype(float), y.ravel().astype(float), a, b, street_class
+
+
+def radial_streets(target_edges: int, oneway_ratio: float, rng: np.random.Generator,
+                   spacing: float = 150.0):
+    """Concentric rings crossed by spokes; the spokes are primary and every 3rd ring secondary."""
+    streets = target_edges / _edges_per_street(oneway_ratio)
+    rings = max(1, int(round(math.sqrt(streets / 4))))
+    spokes = max(4, 2 * rings)
+    ring = np.repeat(np.arange(1, rings + 1), spokes)
+    angle = np.tile(np.arange(spokes) * 2 * math.pi / spokes, rings)
+    x = np.concatenate([[0.0], ring * spacing * np.cos(angle)])
+    y = np.concatenate([[0.0], ring * spacing * np.sin(angle)])
+    node = np.arange(1, rings * spokes + 1).reshape(rings, spokes)
+    ring_a = node.ravel()
+    ring_b = np.roll(node, -1, axis=1).ravel()
+    spoke_a = np.concatenate([np.zeros(spokes, dtype=int), node[:-1].ravel()])
+    spoke_b = np.concatenate([node[0], node[1:].ravel()])
+    a = np.concatenate([ring_a, spoke_a])
+    b = np.concatenate([ring_b, spoke_b])
+    ring_class = np.where(np.repeat(np.arange(1, rings + 1), spokes) % 3 == 0, SECONDARY, RESIDENTIAL)
+    street_class = np.concatenate([ring_class, np.full(len(spoke_a), PRIMARY)])
+    # an outer ring road
+    street_class[len(ring_a) - spokes:len(ring_a)] = MOTORWAY
+    return x, y, a, b, street_class
+
+
+def planar_streets(target_edges: int, oneway_ratio: float, rng: np.random.Generator,
+                   spacing: float = 100.0):
+    """Jittered grid with missing streets and diagonals, planar by construction."""
+    # per cell: 2 grid streets of which 15% are dropped plus a diagonal in 30% of the cells
+    streets = target_edges / _edges_per_street(oneway_ratio)
+    n = max(2, int(round(math.sqrt(streets / (2 * 0.85 + 0.3)))) + 1)
+    index = np.arange(n * n).reshape(n, n)
+    jitter = rng.uniform(-0.25, 0.25, size=(2, n, n)) * spacing
+    x, y = np.meshgrid(np.arange(n) * spacing, np.arange(n) * spacing)
+    x = (x + jitter[0]).ravel()
+    y = (y + jitter[1]).ravel()
+    a = np.concatenate([index[:, :-1].ravel(), index[:-1, :].ravel()])
+    b = np.concatenate([index[:, 1:].ravel(), index[1:, :].ravel()])
+    keep = rng.random(len(a)) >= 0.15
+    a, b = a[keep], b[keep]
+    cells = index[:-1, :-1].ravel()
+    diagonal = rng.random(len(cells)) < 0.3
+    # one diagonal per cell, in either direction
+    rising = rng.random(len(cells)) < 0.5
+    diag_a = np.where(rising, cells, cells + 1)[diagonal]
+    diag_b = np.where(rising, cells + n + 1, cells + n)[diagonal]
+    a = np.concatenate([a, diag_a])
+    b = np.concatenate([b, diag_b])
+    street_class = rng.choice([RESIDENTIAL, SECONDARY, PRIMARY], size=len(a), p=[0.7, 0.2, 0.1])
+    return x, y, a, b, street_class
+
+
+STREET_BUILDERS = {"grid": grid_streets, "radial": radial_streets, "planar": planar_streets}
+
+
+def directed_edges(a, b, street_class, oneway_ratio: float, rng: np.random.Generator):
+    """Turns streets into edges, minor streets are one-way (in random direction) with the given probability."""
+    oneway = (street_class == RESIDENTIAL) & (rng.random(len(a)) < oneway_ratio)
+    flip = oneway & (rng.random(len(a)) < 0.5)
+    src = np.where(flip, b, a)
+    dst = np.where(flip, a, b)
+    two_way = ~oneway
+    edge_from = np.concatenate([src, dst[two_way]])
+    edge_to = np.concatenate([dst, src[two_way]])
+    edge_class = np.concatenate([street_class, street_class[two_way]])
+    return edge_from, edge_to, edge_class
+
+
+def connections(edge_from, edge_to, num_nodes: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Every edge connects to all edges leaving its end node except for the
+    turnaround, which is only kept at dead ends. Returns the connections and
+    whether they are turnarounds."""
+    order = np.argsort(edge_from, kind="stable")
+    out_degree = np.bincount(edge_from, minlength=num_nodes)
+    offsets = np.concatenate([[0], np.cumsum(out_degree)])
+    count = out_degree[edge_to]
+    conn_from = np.repeat(np.arange(len(edge_from)), count)
+    # position of each connection within the outgoing edges of the end node
+    rank = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+    conn_to = order[offsets[edge_to[conn_from]] + rank]
+    turnaround = edge_to[conn_to] == edge_from[conn_from]
+    keep = ~turnaround | (count[conn_from] == 1)
+    return conn_from[keep], conn_to[keep], turnaround[keep]
+
+
+def build_net(kind: str, target_edges: int, oneway_ratio: float = 0.5, seed: int = 42):
+    """Builds a synthetic network of roughly target_edges edges as netcache.CompiledNet."""
+    rng = np.random.default_rng(seed)
+    x, y, a, b, street_class = STREET_BUILDERS[kind](target_edges, oneway_ratio, rng)
+    edge_from, edge_to, edge_class = directed_edges(a, b, street_class, oneway_ratio, rng)
+    conn_from, conn_to, turnaround = connections(edge_from, edge_to, len(x))
+    num_edges = len(edge_from)
+
+    # fringe edges as in sumolib: all connections on that side are turnarounds (or there are none)
+    regular_out = np.bincount(conn_from[~turnaround], minlength=num_edges)
+    regular_in = np.bincount(conn_to[~turnaround], minlength=num_edges)
+    fringe = ((regular_in == 0) * netcache.FRINGE_INCOMING) | ((regular_out == 0) * netcache.FRINGE_OUTGOING)
+
+    xmin, ymin = x.min(), y.min()
+    x, y = x - xmin, y - ymin
+    speed, lanes = [np.array([c[i] for c in SPEED_CLASSES])[edge_class] for i in (1, 2)]
+    bbox = np.stack([np.minimum(x[edge_from], x[edge_to]), np.minimum(y[edge_from], y[edge_to]),
+                     np.maximum(x[edge_from], x[edge_to]), np.maximum(y[edge_from], y[edge_to])], axis=1)
+    arrays = {
+        "edge_from": edge_from.astype(np.int32),
+        "edge_to": edge_to.astype(np.int32),
+        "edge_length": np.maximum(np.hypot(x[edge_to] - x[edge_from], y[edge_to] - y[edge_from]), 0.1),
+        "edge_speed": speed.astype(np.float64),
+        "edge_lanes": lanes.astype(np.int32),
+        "edge_type": edge_class.astype(np.int32),
+        "edge_permissions": np.ones(num_edges, dtype=np.uint64),
+        "edge_fringe": fringe.astype(np.uint8),
+        "edge_bbox": bbox,
+        "node_x": x,
+        "node_y": y,
+        "conn_from": conn_from.astype(np.int32),
+        "conn_to": conn_to.astype(np.int32),
+        "conn_permissions": np.ones(len(conn_from), dtype=np.uint64),
+    }
+    header = {
+        "sha1": None,
+        "edge_ids": ["e%s" % i for i in range(num_edges)],
+        "node_ids": ["n%s" % i for i in range(len(x))],
+        "types": [c[0] for c in SPEED_CLASSES],
+        "vclasses": ["passenger"],
+        "edge_params": {},
+        "boundary": [0.0, 0.0, float(x.max()), float(y.max())],
+        "ranges": [[0.0, float(x.max())], [0.0, float(y.max())]],
+    }
+    return netcache.CompiledNet(header, arrays)
+
+
+def write_plain(net, prefix: str):
+    """Writes <prefix>.nod.xml and <prefix>.edg.xml for netconvert."""
+    with open(prefix + ".nod.xml", "w") as f:
+        f.write("<nodes>\n")
+        for node in net.getNodes():
+            f.write('    <node id="%s" x="%.2f" y="%.2f"/>\n' % ((node.getID(),) + tuple(node.getCoord())))
+        f.write("</nodes>\n")
+    with open(prefix + ".edg.xml", "w") as f:
+        f.write("<edges>\n")
+        for edge in net.getEdges():
+            f.write('    <edge id="%s" from="%s" to="%s" type="%s" speed="%.2f" numLanes="%s"/>\n' % (
+                edge.getID(), edge.getFromNode().getID(), edge.getToNode().getID(), edge.getType(),
+                edge.getSpeed(), edge.getLaneNumber()))
+        f.write("</edges>\n")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Generate a synthetic road network")
+    parser.add_argument("kind", choices=KINDS)
+    parser.add_argument("edges", type=int, help="approximate number of edges")
+    parser.add_argument("-o", "--output-prefix", required=True, help="prefix of the generated files")
+    parser.add_argument("--oneway-ratio", type=float, default=0.5, help="share of one-way minor streets")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--netconvert", action="store_true", help="build <prefix>.net.xml with netconvert")
+    args = parser.parse_args()
+    net = build_net(args.kind, args.edges, args.oneway_ratio, args.seed)
+    write_plain(net, args.output_prefix)
+    print("%s network with %s edges and %s nodes" % (args.kind, len(net.getEdges()), len(net.getNodes())))
+    if args.netconvert:
+        netconvert = "netconvert"
+        if "SUMO_HOME" in os.environ:
+            netconvert = os.path.join(os.environ["SUMO_HOME"], "bin", "netconvert")
+        return subprocess.call([netconvert, "-n", args.output_prefix + ".nod.xml", "-e", args.output_prefix +
+                                ".edg.xml", "-o", args.output_prefix + ".net.xml", "--no-turnarounds.except-deadend"])
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,94 @@
+"""Offline stand-in for the TraCI client used by the benchmarks.
+
+Only the calls made by the routing code are provided. The vehicle states are
+synthetic but deterministic for a given seed, so that benchmark runs are
+comparable without a running SUMO server.
+"""
+import math
+import random
+from typing import Dict, List, Tuple
+
+
+class TraCIException(Exception):
+    pass
+
+
+class _EdgeDomain:
+    def __init__(self, stub: "TraCIStub"):
+        self._stub = stub
+
+    def getLastStepVehicleIDs(self, edge_id: str) -> List[str]:
+        return self._stub.vehicles_on_edge.get(edge_id, [])
+
+    def getLastStepVehicleNumber(self, edge_id: str) -> int:
+        return len(self._stub.vehicles_on_edge.get(edge_id, []))
+
+
+class _VehicleDomain:
+    def __init__(self, stub: "TraCIStub"):
+        self._stub = stub
+
+    def _state(self, vehicle_id: str) -> Tuple[float, float, float, float]:
+        try:
+            return self._stub.vehicle_states[vehicle_id]
+        except KeyError:
+            raise TraCIException(f"Vehicle '{vehicle_id}' is not known")
+
+    def getPosition(self, vehicle_id: str) -> Tuple[float, float]:
+        x, y, _, _ = self._state(vehicle_id)
+        return x, y
+
+    def getSpeed(self, vehicle_id: str) -> float:
+        return self._state(vehicle_id)[2]
+
+    def getAngle(self, vehicle_id: str) -> float:
+        return self._state(vehicle_id)[3]
+
+    def getIDList(self) -> List[str]:
+        return list(self._stub.vehicle_states)
+
+
+class TraCIStub:
+    """Places random vehicles on the edges of a network.
+
+    Each edge receives a Poisson distributed number of vehicles with mean
+    ``vehicles_per_km`` times its length. Vehicles are spread along the edge
+    shape with speeds up to the edge speed and the heading of the edge.
+    """
+
+    TraCIException = TraCIException
+
+    def __init__(self, net, vehicles_per_km: float = 20.0, seed: int = 42):
+        rng = random.Random(seed)
+        self.vehicles_on_edge: Dict[str, List[str]] = {}
+        self.vehicle_states: Dict[str, Tuple[float, float, float, float]] = {}
+        for edge in net.getEdges():
+            (x1, y1), (x2, y2) = edge.getFromNode().getCoord()[:2], edge.getToNode().getCoord()[:2]
+            heading = math.degrees(math.atan2(x2 - x1, y2 - y1)) % 360
+            count = self._poisson(rng, vehicles_per_km * edge.getLength() / 1000.0)
+            ids = []
+            for i in range(count):
+                vehicle_id = f"{edge.getID()}.{i}"
+                share = rng.random()
+                speed = rng.uniform(0.3, 1.0) * edge.getSpeed()
+                self.vehicle_states[vehicle_id] = (
+                    x1 + share * (x2 - x1), y1 + share * (y2 - y1), speed, heading)
+                ids.append(vehicle_id)
+            if ids:
+                self.vehicles_on_edge[edge.getID()] = ids
+        self.edge = _EdgeDomain(self)
+        self.vehicle = _VehicleDomain(self)
+
+    @staticmethod
+    def _poisson(rng: random.Random, mean: float) -> int:
+        # Knuth's method, the means per edge are small
+        limit = math.exp(-mean)
+        count = 0
+        product = rng.random()
+        while product > limit:
+            count += 1
+            product *= rng.random()
+        return count
+
+    def close(self):
+        pass
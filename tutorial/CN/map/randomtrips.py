@@ -1,12 +1,21 @@
+import functools
+import logging
 import random
 from xml.etree import ElementTree as ET
 import traci
+import tracing
 from acoTrips import CAMOACO
+from rerouting import ReroutingScheduler, RouteApplier, PipelinedControlLoop
 
 # Generate trips with customizable parameters
 num_vehicles = 100
 trip_length = 10  # Average trip length in km
 speed_range = (20, 30)  # Average speed range in km/h
+incremental = True  # Keep each vehicle's colony between steps instead of restarting it
+step_budget_ms = 50  # Compute budget for rerouting per simulation step
+pipeline_lag = 0  # Steps SUMO runs ahead of route computation (0 keeps the synchronous loop)
+trace_file = None  # Chrome trace-event JSON of the run for Perfetto (None disables tracing)
+alternatives_file = None  # duarouter alternatives seeding the pheromone trails, e.g. 'nycmap.rou.alt.xml'
 
 # Create the root element for the trips.xml file
 root = ET.Element('trips')
@@ -37,28 +46,124 @@ for i in range(num_vehicles):
     route = ET.SubElement(vehicle, 'route')
     route.text = ' '.join(['edge_{}'.format(j) for j in range(int(trip_distance // 100))])
 
+if trace_file:
+    tracing.enable()
+
 # Write the trips.xml file
 tree = ET.ElementTree(root)
-tree.write('trips.xml', encoding='utf-8', xml_declaration=True)
+with tracing.span("write trips.xml", "io"):
+    tree.write('trips.xml', encoding='utf-8', xml_declaration=True)
 
 # Load the SUMO network and trips
-net = traci.load(['--net-file', 'nycmap.net.xml', '--route-files', 'trips.xml'])
+with tracing.span("traci.load", "traci"):
+    net = traci.load(['--net-file', 'nycmap.net.xml', '--route-files', 'trips.xml'])
 
 camo_aco = CAMOACO(num_ants=50, alpha=1, beta=2, rho=0.5, q0=0.8, max_iterations=100)
-
-for step in range(net.getMinExpectedNumber()):
-    traci.simulationStep()
-
-    # Retrieve current vehicle positions and states
-    vehicles = traci.vehicle.getIDList()
-    for vehicle_id in vehicles:
+if alternatives_file:
+    camo_aco.warm_start(alternatives_file)
+scheduler = ReroutingScheduler(budget_ms=step_budget_ms)
+route_applier = RouteApplier(tracing.traced("traci.vehicle.setRoute", "traci")(traci.vehicle.setRoute))
+simulation_step = tracing.traced("traci.simulationStep", "traci")(traci.simulationStep)
+trips = {}
+lane_lengths = {}
+
+
+def lane_length(lane_id):
+    # Lane lengths do not change during the simulation, read each one once
+    length = lane_lengths.get(lane_id)
+    if length is None:
+        length = lane_lengths[lane_id] = traci.lane.getLength(lane_id)
+    return length
+
+
+def forget_vehicle(vehicle_id):
+    # Drop the colony and the scheduling state of a vehicle that has arrived
+    camo_aco.forget(vehicle_id)
+    scheduler.forget(vehicle_id)
+
+
+@tracing.traced("observe", "traci")
+def observe(step, forget=forget_vehicle):
+    # Forget the vehicles that have reached their destination
+    for vehicle_id in traci.simulation.getArrivedIDList():
+        forget(vehicle_id)
+        route_applier.forget(vehicle_id)
+
+    # Retrieve current vehicle positions and states. Only the distance to the
+    # junction is read for every vehicle, the cost change of the kept route is
+    # the estimate cached by CAMOACO, without TraCI calls
+    tasks = []
+    for vehicle_id in traci.vehicle.getIDList():
         current_edge = traci.vehicle.getRoadID(vehicle_id)
+        if current_edge.startswith(':'):
+            continue  # routes cannot start on internal junction edges
         destination_edge = traci.vehicle.getRoute(vehicle_id)[-1]
-
-        # Run CAMO-ACO to find the optimal route for the vehicle
+        distance_to_junction = (lane_length(traci.vehicle.getLaneID(vehicle_id)) -
+                                traci.vehicle.getLanePosition(vehicle_id))
+        tasks.append((vehicle_id, distance_to_junction, current_edge, destination_edge))
+    return tasks
+
+
+@tracing.traced("compute_route", "aco")
+def compute_route(vehicle_id, current_edge, destination_edge):
+    # Run CAMO-ACO to find the optimal route for the vehicle
+    if incremental:
+        best_path, best_cost = camo_aco.reoptimize(vehicle_id, current_edge, destination_edge)
+    else:
         best_path, best_cost = camo_aco.run(current_edge, destination_edge)
+    if best_path is None:
+        # No ant reached the destination, the vehicle keeps its current route
+        logging.warning("no route found for %s from %s to %s", vehicle_id, current_edge, destination_edge)
+    return best_path
+
+
+def route_cost_change(vehicle_id, current_edge, destination_edge):
+    return camo_aco.estimated_cost_change(vehicle_id, current_edge)
 
-        # Update the vehicle's route in the SUMO simulation
-        traci.vehicle.setRoute(vehicle_id, best_path)
+
+def reroute(vehicle_id):
+    best_path = compute_route(vehicle_id, *trips[vehicle_id])
+    if best_path is None:
+        return
+
+    # Update the vehicle's route in the SUMO simulation (sent with the step's batch)
+    route_applier.update(vehicle_id, best_path)
+
+
+def apply_late_route(vehicle_id, best_path):
+    # The route was computed for an earlier step, the vehicle may have moved on
+    try:
+        current_edge = traci.vehicle.getRoadID(vehicle_id)
+    except traci.TraCIException:
+        return  # arrived in the meantime
+    if best_path and current_edge in best_path:
+        route_applier.update(vehicle_id, best_path[best_path.index(current_edge):])
+
+
+if pipeline_lag > 0:
+    # Compute the routes of step t while SUMO performs step t + 1. A single
+    # worker keeps the colonies of CAMOACO free of concurrent updates.
+    with PipelinedControlLoop(compute_route, lag=pipeline_lag, scheduler=scheduler,
+                              cost_change=route_cost_change, forget=forget_vehicle) as control_loop:
+        control_loop.run(net.getMinExpectedNumber(), simulation_step,
+                         functools.partial(observe, forget=control_loop.forget), apply_late_route,
+                         route_applier.flush)
+else:
+    for step in range(net.getMinExpectedNumber()):
+        simulation_step()
+
+        tasks = observe(step)
+        trips = dict((task[0], task[2:]) for task in tasks)
+
+        # Reroute the most urgent vehicles within the step budget, defer the rest
+        with tracing.span("scheduler.run", "aco", step=step, candidates=len(tasks)):
+            scheduler.run(step, [(vehicle_id, distance, route_cost_change(vehicle_id, *trip))
+                                 for vehicle_id, distance, *trip in tasks], reroute)
+
+        # Send the routes which changed as one batch
+        route_applier.flush()
 
 traci.close()
+
+if trace_file:
+    tracing.export(trace_file)
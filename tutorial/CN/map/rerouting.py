@@ -0,0 +1,199 @@
+import asyncio
+import heapq
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from tracing import traced
+
+
+class ReroutingScheduler:
+    # Spreads the rerouting of a growing fleet over several simulation steps.
+    # Every step the vehicles are ranked by how long ago they were rerouted,
+    # how close they are to the next junction (where a new route still makes a
+    # difference) and how much the cost of their route has changed. Vehicles
+    # are rerouted in that order until the compute budget of the step is used
+    # up, the rest is deferred and becomes more urgent with every step (up to
+    # max_staleness steps).
+    def __init__(self, budget_ms, max_staleness=10, junction_distance=50.0,
+                 staleness_weight=1.0, junction_weight=1.0, cost_weight=1.0, min_per_step=1):
+        self.budget_ms = budget_ms
+        self.max_staleness = max_staleness  # steps after which staleness counts as 1.0
+        self.junction_distance = junction_distance  # distance (m) at which proximity counts as 0.5
+        self.staleness_weight = staleness_weight
+        self.junction_weight = junction_weight
+        self.cost_weight = cost_weight
+        self.min_per_step = min_per_step  # rerouted even if the budget is exceeded
+        self.last_rerouted = {}
+        self.rerouted = 0
+        self.deferred = 0
+
+    def priority(self, vehicle_id, step, distance_to_junction, cost_change):
+        # Vehicles which have never been rerouted start as stale as allowed
+        last = self.last_rerouted.get(vehicle_id, step - self.max_staleness)
+        staleness = min(1.0, (step - last) / self.max_staleness)
+        proximity = self.junction_distance / (self.junction_distance + max(distance_to_junction, 0.0))
+        return (self.staleness_weight * staleness +
+                self.junction_weight * proximity +
+                self.cost_weight * cost_change)
+
+    def run(self, step, candidates, reroute):
+        # candidates: (vehicle id, distance to the next junction, relative change of route cost)
+        # reroute: callable computing and applying the route of one vehicle
+        # The cost change has to be cheap to get for every vehicle, e.g. the one
+        # cached by CAMOACO.estimated_cost_change, so that collecting the
+        # candidates does not grow the step time with the fleet
+        deadline = time.perf_counter() + self.budget_ms / 1000.0
+        queue = [(-self.priority(vehicle_id, step, distance, cost_change), vehicle_id)
+                 for vehicle_id, distance, cost_change in candidates]
+        heapq.heapify(queue)
+
+        rerouted = 0
+        while queue:
+            if rerouted >= self.min_per_step and time.perf_counter() >= deadline:
+                break
+            _, vehicle_id = heapq.heappop(queue)
+            reroute(vehicle_id)
+            self.last_rerouted[vehicle_id] = step
+            rerouted += 1
+
+        self.rerouted = rerouted
+        self.deferred = len(queue)
+        return rerouted
+
+    def forget(self, vehicle_id):
+        self.last_rerouted.pop(vehicle_id, None)
+
+
+class RouteApplier:
+    # Sends routes to SUMO only when they change what is left of the route
+    # applied last. Updates are collected during a step (the last one per
+    # vehicle wins) and flushed together once per step.
+    def __init__(self, set_route):
+        self.set_route = set_route  # (vehicle id, edges) -> None, e.g. traci.vehicle.setRoute
+        self.applied = {}
+        self.pending = {}
+        self.sent = 0
+        self.skipped = 0
+
+    def update(self, vehicle_id, route):
+        if not route:
+            return
+        applied = self.applied.get(vehicle_id)
+        if applied is not None and route[0] in applied:
+            # The vehicle has driven the part before route[0] in the meantime
+            remaining = applied[applied.index(route[0]):]
+            if remaining == list(route):
+                self.pending.pop(vehicle_id, None)
+                self.skipped += 1
+                return
+        self.pending[vehicle_id] = list(route)
+
+    @traced("RouteApplier.flush", "traci")
+    def flush(self):
+        for vehicle_id, route in self.pending.items():
+            self.set_route(vehicle_id, route)
+            self.applied[vehicle_id] = route
+        self.sent += len(self.pending)
+        self.pending = {}
+
+    def forget(self, vehicle_id):
+        self.applied.pop(vehicle_id, None)
+        self.pending.pop(vehicle_id, None)
+
+
+class PipelinedControlLoop:
+    # Overlaps SUMO and Python: while the routes based on the vehicle states of
+    # step t are computed in a worker pool, SUMO already performs the next
+    # step. Routes are applied `lag` steps after the states they are based on
+    # were read, so the apply callable has to cope with vehicles that moved on
+    # or arrived in the meantime. With a scheduler, the vehicles of a batch are
+    # rerouted in its order and within its budget, as in the synchronous loop.
+    def __init__(self, compute, lag=1, executor=None, scheduler=None, cost_change=None, forget=None):
+        if lag < 1:
+            raise ValueError("lag must be at least 1")
+        self.compute = compute  # (vehicle id, *args) -> route, runs in the worker pool
+        self.lag = lag
+        self.scheduler = scheduler  # ReroutingScheduler, None computes the route of every vehicle
+        self.cost_change = cost_change  # (vehicle id, *args) -> cheap estimate of the relative change of route cost
+        self.forget_vehicle = forget  # vehicle id -> None, drops the worker state of an arrived vehicle
+        # Arrived vehicles are reported on the TraCI thread while the worker may
+        # still compute their routes, so the worker forgets them itself before
+        # its next batch
+        self.forgotten = deque()
+        # The batches and the state of the compute function are only touched by
+        # one worker thread unless another executor is passed
+        self.own_executor = executor is None
+        self.executor = executor or ThreadPoolExecutor(max_workers=1)
+        # TraCI connections are not thread safe, so every call goes through one thread
+        self.traci_thread = ThreadPoolExecutor(max_workers=1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.own_executor:
+            self.executor.shutdown()
+        self.traci_thread.shutdown()
+
+    def forget(self, vehicle_id):
+        # Safe to call from the TraCI thread
+        self.forgotten.append(vehicle_id)
+
+    def run(self, steps, simulation_step, observe, apply, flush=None):
+        # simulation_step: advances SUMO by one step (traci.simulationStep)
+        # observe: step -> list of (vehicle id, distance to the next junction, *args) tasks
+        # apply: (vehicle id, route) -> None, sends (or queues) a route
+        # flush: called after each applied batch, e.g. RouteApplier.flush
+        asyncio.run(self.run_async(steps, simulation_step, observe, apply, flush))
+
+    async def run_async(self, steps, simulation_step, observe, apply, flush=None):
+        loop = asyncio.get_running_loop()
+        pending = deque()
+        for step in range(steps):
+            # The batches in flight keep computing while SUMO steps
+            await loop.run_in_executor(self.traci_thread, simulation_step)
+
+            while pending and step - pending[0][0] >= self.lag:
+                await self._apply(loop, pending.popleft()[1], apply, flush)
+
+            tasks = await loop.run_in_executor(self.traci_thread, observe, step)
+            pending.append((step, loop.run_in_executor(self.executor, self.compute_batch, step, tasks)))
+
+        while pending:
+            await self._apply(loop, pending.popleft()[1], apply, flush)
+
+    def compute_batch(self, step, tasks):
+        # Runs in the worker pool, returns the (vehicle id, route) pairs computed
+        while self.forgotten:
+            vehicle_id = self.forgotten.popleft()
+            if self.forget_vehicle is not None:
+                self.forget_vehicle(vehicle_id)
+
+        args = dict((task[0], task[2:]) for task in tasks)
+        routes = []
+
+        def reroute(vehicle_id):
+            routes.append((vehicle_id, self.compute(vehicle_id, *args[vehicle_id])))
+
+        if self.scheduler is None:
+            for vehicle_id in args:
+                reroute(vehicle_id)
+        else:
+            # the estimates are read here since the state behind them belongs to the worker
+            candidates = [(task[0], task[1], self.cost_change(task[0], *task[2:]) if self.cost_change else 0.0)
+                          for task in tasks]
+            self.scheduler.run(step, candidates, reroute)
+        return routes
+
+    async def _apply(self, loop, routes, apply, flush):
+        routes = await routes
+
+        def apply_all():
+            for vehicle_id, route in routes:
+                apply(vehicle_id, route)
+            if flush is not None:
+                flush()
+        await loop.run_in_executor(self.traci_thread, apply_all)
@@ -1,5 +1,6 @@
 import os
 import sys
+import argparse
 import random
 import sumolib
 import traci
@@ -8,10 +9,24 @@ import numpy as np
 import logging
 from collections import defaultdict
 from typing import List, Dict, Tuple
+import netcache
+import routeloader
+import rsu_coverage
+from history import EdgeHistory
+from obstacles import ObstacleIndex
+from routestore import EdgeIndex, RouteStore, RouteTrie
+from tracing import span, traced
 
 class VANETMetrics:
-    def __init__(self, net: sumolib.net.Net):
+    def __init__(self, net: sumolib.net.Net, obstacles: ObstacleIndex = None,
+                 rsu_coverage: Dict[str, float] = None, history_window: int = 30):
         self.net = net
+        self.edge_index = EdgeIndex(net)
+        # Last history_window samples of reliability, density and speed per
+        # edge; whoever advances SUMO calls next_step() after each step
+        self.history = EdgeHistory(len(self.edge_index), history_window)
+        self.obstacles = obstacles  # building shadowing of the RSSI, None ignores buildings
+        self.edge_shadowing = {}  # batch results of update_shadowing() for the current step
         # Configuration parameters
         self.rssi_threshold = -85  # dBm
         self.snr_threshold = 10    # dB
@@ -19,10 +34,19 @@ class VANETMetrics:
         self.max_speed = 30       # m/s
         self.communication_range = 300  # meters
         
+        # Best RSU power per edge (dBm, see rsu_coverage.py), normalized like the RSSI
+        self.rsu_coverage = None
+        if rsu_coverage is not None:
+            self.rsu_coverage = {
+                edge_id: min(max((power - self.rssi_threshold) / (-40 - self.rssi_threshold), 0.0), 1.0)
+                for edge_id, power in rsu_coverage.items()
+            }
+        
         # Initialize logging
         logging.basicConfig(level=logging.INFO)
         self.logger = logging.getLogger("VANETMetrics")
 
+    @traced("VANETMetrics.get_rssi", "metrics")
     def get_rssi(self, edge_id: str) -> float:
         """Simulate RSSI based on vehicle positions and density"""
         try:
@@ -36,11 +60,54 @@ class VANETMetrics:
             
             # Path loss model: RSSI = -20log₁₀(d) - 20log₁₀(f) + 27.55
             rssi = -20 * math.log10(max(avg_distance, 1)) - 40 + random.uniform(-5, 5)
+            if self.obstacles is not None:
+                shadowing = self.edge_shadowing.get(edge_id)
+                if shadowing is None:
+                    shadowing = self._calculate_average_shadowing(vehicle_positions)
+                rssi -= shadowing
             return min(max(rssi, self.rssi_threshold), -40)
         except traci.TraCIException as e:
             self.logger.warning(f"Error getting RSSI for edge {edge_id}: {e}")
             return self.rssi_threshold
 
+    def next_step(self):
+        """Call after every traci.simulationStep(): starts a new sample of the
+        metric history and drops the shadowing of the previous step"""
+        self.history.next_step()
+        self.edge_shadowing = {}
+
+    @traced("VANETMetrics.update_shadowing", "metrics")
+    def update_shadowing(self, edge_ids: List[str]) -> Dict[str, float]:
+        """Average building shadowing between the vehicles of each edge, for all
+        vehicle pairs of all edges in one batch query. Call after next_step() for
+        the edges whose RSSI is needed in the step; other edges are computed on
+        demand by get_rssi"""
+        self.edge_shadowing = {}
+        if self.obstacles is None:
+            return self.edge_shadowing
+        try:
+            first, second, groups, measured = [], [], [], []
+            for edge_id in edge_ids:
+                vehicles = traci.edge.getLastStepVehicleIDs(edge_id)
+                if len(vehicles) < 2:
+                    self.edge_shadowing[edge_id] = 0.0
+                    continue
+                points = np.array([traci.vehicle.getPosition(v) for v in vehicles], dtype=np.float64)[:, :2]
+                i, j = np.triu_indices(len(points), k=1)
+                first.append(points[i])
+                second.append(points[j])
+                groups.append(np.full(len(i), len(measured)))
+                measured.append(edge_id)
+            if measured:
+                groups = np.concatenate(groups)
+                attenuation = self.obstacles.attenuation(np.concatenate(first), np.concatenate(second))
+                means = np.bincount(groups, weights=attenuation) / np.bincount(groups)
+                self.edge_shadowing.update(zip(measured, means.tolist()))
+        except traci.TraCIException as e:
+            self.logger.warning(f"Error updating building shadowing: {e}")
+        return self.edge_shadowing
+
+    @traced("VANETMetrics.get_snr", "metrics")
     def get_snr(self, edge_id: str) -> float:
         """Calculate SNR based on vehicle density and traffic conditions"""
         try:
@@ -57,6 +124,7 @@ class VANETMetrics:
             self.logger.warning(f"Error calculating SNR for edge {edge_id}: {e}")
             return 0
 
+    @traced("VANETMetrics.calculate_link_reliability", "metrics")
     def calculate_link_reliability(self, edge_id: str) -> float:
         """Calculate comprehensive link reliability"""
         try:
@@ -74,11 +142,17 @@ class VANETMetrics:
                 0.3 * norm_snr +
                 0.3 * stability
             )
-            return max(min(reliability, 1.0), 0.0)
+            if self.rsu_coverage is not None:
+                # Vehicle-to-vehicle and RSU links as independent alternatives
+                reliability = 1 - (1 - reliability) * (1 - self.rsu_coverage.get(edge_id, 0.0))
+            reliability = max(min(reliability, 1.0), 0.0)
+            self._record("reliability", edge_id, reliability)
+            return reliability
         except Exception as e:
             self.logger.error(f"Error calculating link reliability: {e}")
             return 0.0
 
+    @traced("VANETMetrics.get_connection_stability", "metrics")
     def get_connection_stability(self, edge_id: str) -> float:
         """Calculate connection stability based on vehicle movements"""
         try:
@@ -88,6 +162,7 @@ class VANETMetrics:
             
             speeds = [traci.vehicle.getSpeed(v) for v in vehicles]
             directions = [traci.vehicle.getAngle(v) for v in vehicles]
+            self._record("speed", edge_id, sum(speeds) / len(speeds))
             
             # Calculate stability based on speed and direction variations
             speed_var = np.var(speeds) if len(speeds) > 1 else 0
@@ -99,6 +174,7 @@ class VANETMetrics:
             self.logger.warning(f"Error calculating connection stability: {e}")
             return 1.0
 
+    @traced("VANETMetrics.calculate_vehicle_density", "metrics")
     def calculate_vehicle_density(self, edge_id: str) -> float:
         """Calculate normalized vehicle density"""
         try:
@@ -106,11 +182,19 @@ class VANETMetrics:
             num_vehicles = traci.edge.getLastStepVehicleNumber(edge_id)
             density = num_vehicles / max(edge_length, 0.001)
             
-            return min(density / self.optimal_density, 1.0)
+            density = min(density / self.optimal_density, 1.0)
+            self._record("density", edge_id, density)
+            return density
         except Exception as e:
             self.logger.warning(f"Error calculating vehicle density: {e}")
             return 0.0
 
+    def _record(self, metric: str, edge_id: str, value: float):
+        """Add a sample to the metric history of the edge"""
+        edge = self.edge_index.index.get(edge_id)
+        if edge is not None:
+            self.history.record(metric, edge, value)
+
     def _calculate_average_distance(self, positions: List[Tuple[float, float]]) -> float:
         """Calculate average distance between vehicles"""
         if len(positions) < 2:
@@ -127,6 +211,16 @@ class VANETMetrics:
         
         return sum(distances) / len(distances)
 
+    def _calculate_average_shadowing(self, positions: List[Tuple[float, float]]) -> float:
+        """Calculate average building shadowing (dB) between vehicles"""
+        if len(positions) < 2:
+            return 0.0
+        
+        # All vehicle pairs in one batch query of the obstacle index
+        points = np.asarray(positions, dtype=np.float64)[:, :2]
+        first, second = np.triu_indices(len(points), k=1)
+        return float(self.obstacles.attenuation(points[first], points[second]).mean())
+
     def _calculate_angular_variance(self, angles: List[float]) -> float:
         """Calculate variance of angular values"""
         if len(angles) < 2:
@@ -141,10 +235,13 @@ class VANETMetrics:
         return 1 - R
 
 class VANETACO:
-    def __init__(self, net: sumolib.net.Net, step_length: float = 0.1):
+    def __init__(self, net: sumolib.net.Net, step_length: float = 0.1, obstacles: ObstacleIndex = None,
+                 rsu_coverage: Dict[str, float] = None):
         self.net = net
-        self.metrics = VANETMetrics(net)
+        self.metrics = VANETMetrics(net, obstacles, rsu_coverage)
         self.step_length = step_length
+        # Routes are int32 arrays of indices into edge_index.ids
+        self.edge_index = self.metrics.edge_index
         
         # ACO parameters
         self.alpha = 1.0    # Pheromone influence
@@ -159,38 +256,73 @@ class VANETACO:
         self.min_pheromone = 0.1
         self.max_pheromone = 5.0
         self.evaporation_rate = 0.1
+        self.dynamics_mode = "variance"  # volatility from the "variance" of the metric window or "ewma"
         
         # Setup logging
         self.logger = logging.getLogger("VANETACO")
 
-    def select_route(self, start_edge_id: str, dest_edge_id: str) -> List[str]:
-        """Select optimal route using VANET-ACO algorithm"""
+    def warm_start_pheromones(self, alternatives_file: str) -> int:
+        """Seed the pheromone matrix from duarouter route alternatives
+
+        Every edge gets pheromone in proportion to the probability / cost of
+        the routes using it, scaled so that the best edge reaches
+        max_pheromone and bounded by min_pheromone. The file is streamed, so
+        it may be larger than memory. Returns the number of seeded edges.
+        """
+        try:
+            deposits = routeloader.edge_deposits(alternatives_file, self.edge_index)
+            levels = routeloader.pheromone_levels(deposits, 1.0, self.min_pheromone, self.max_pheromone)
+            seeded = np.flatnonzero(deposits > 0)
+            for i, level in zip(seeded.tolist(), levels[seeded].tolist()):
+                self.pheromone_matrix[self.edge_index.ids[i]] = level
+            self.logger.info(f"Seeded pheromones of {len(seeded)} edges from {alternatives_file}")
+            return len(seeded)
+        except Exception as e:
+            self.logger.error(f"Error seeding pheromones from {alternatives_file}: {e}")
+            return 0
+
+    @traced("VANETACO.select_route", "aco")
+    def select_route(self, start_edge_id: str, dest_edge_id: str) -> np.ndarray:
+        """Select optimal route using VANET-ACO algorithm, as int32 array of edge indices.
+
+        Returns an empty array for a start edge which is not in the network
+        (e.g. an internal junction edge). Use select_route_ids for the edge IDs.
+        """
+        index = self.edge_index.index
+        if start_edge_id not in index:
+            self.logger.warning(f"Cannot route from unknown edge {start_edge_id}")
+            return np.zeros(0, dtype=np.int32)
+        route = [index[start_edge_id]]
         try:
             current_edge_id = start_edge_id
-            route = [current_edge_id]
+            visited = {current_edge_id}
             
             while current_edge_id != dest_edge_id:
                 next_edge_id = self._select_next_edge(current_edge_id, dest_edge_id)
-                if not next_edge_id or next_edge_id in route:  # Avoid loops
+                if not next_edge_id or next_edge_id in visited:  # Avoid loops
                     break
                 
-                route.append(next_edge_id)
+                route.append(index[next_edge_id])
+                visited.add(next_edge_id)
                 current_edge_id = next_edge_id
                 
                 if len(route) > 100:  # Prevent infinite loops
                     self.logger.warning("Route length exceeded maximum limit")
                     break
-            
-            return route
         except Exception as e:
             self.logger.error(f"Error selecting route: {e}")
-            return [start_edge_id]
+        return np.array(route, dtype=np.int32)
+
+    def select_route_ids(self, start_edge_id: str, dest_edge_id: str) -> List[str]:
+        """Select optimal route as list of edge IDs (the return type of select_route before edge indices)"""
+        return self.edge_index.decode(self.select_route(start_edge_id, dest_edge_id))
 
     def _select_next_edge(self, current_edge_id: str, dest_edge_id: str) -> str:
         """Select next edge based on VANET metrics and pheromone levels"""
         try:
             current_edge = self.net.getEdge(current_edge_id)
-            outgoing_edges = [conn.getTo() for conn in current_edge.getOutgoing()]
+            # getOutgoing maps each successor edge to its connections
+            outgoing_edges = list(current_edge.getOutgoing())
             
             if not outgoing_edges:
                 return None
@@ -253,7 +385,8 @@ class VANETACO:
             self.logger.error(f"Error calculating edge probability: {e}")
             return 0.0
 
-    def update_pheromones(self, route: List[str], quality: float):
+    @traced("VANETACO.update_pheromones", "aco")
+    def update_pheromones(self, route: np.ndarray, quality: float):
         """Update pheromone levels for the route"""
         try:
             # Calculate dynamic evaporation rate based on network conditions
@@ -261,7 +394,7 @@ class VANETACO:
             dynamic_evap_rate = self.evaporation_rate * (1 + 0.5 * network_dynamics)
             
             # Update pheromones for each edge in the route
-            for edge_id in route:
+            for edge_id in self.edge_index.decode(route):
                 current_pheromone = self.pheromone_matrix[edge_id]
                 
                 # Apply evaporation
@@ -279,21 +412,23 @@ class VANETACO:
         except Exception as e:
             self.logger.error(f"Error updating pheromones: {e}")
 
-    def calculate_route_quality(self, route: List[str]) -> float:
+    @traced("VANETACO.calculate_route_quality", "aco")
+    def calculate_route_quality(self, route: np.ndarray) -> float:
         """Calculate comprehensive route quality"""
         try:
-            if not route:
+            if len(route) == 0:
                 return 0.0
                 
             # Calculate various metrics
-            total_length = sum(self.net.getEdge(edge_id).getLength() for edge_id in route)
+            edge_ids = self.edge_index.decode(route)
+            total_length = self.edge_index.lengths[route].sum()
             avg_reliability = np.mean([
                 self.metrics.calculate_link_reliability(edge_id)
-                for edge_id in route
+                for edge_id in edge_ids
             ])
             avg_density = np.mean([
                 self.metrics.calculate_vehicle_density(edge_id)
-                for edge_id in route
+                for edge_id in edge_ids
             ])
             
             # Combined quality metric
@@ -308,27 +443,38 @@ class VANETACO:
             self.logger.error(f"Error calculating route quality: {e}")
             return 0.0
 
-    def _calculate_network_dynamics(self, route: List[str]) -> float:
-        """Calculate network dynamics factor"""
+    @traced("VANETACO._calculate_network_dynamics", "aco")
+    def _calculate_network_dynamics(self, route: np.ndarray) -> float:
+        """Calculate network dynamics factor from the temporal volatility of the route's edges"""
         try:
-            reliability_changes = []
-            density_changes = []
-            
-            for edge_id in route:
-                reliability = self.metrics.calculate_link_reliability(edge_id)
-                density = self.metrics.calculate_vehicle_density(edge_id)
-                reliability_changes.append(reliability)
-                density_changes.append(density)
-            
-            # Calculate variability in network conditions
-            rel_var = np.var(reliability_changes) if len(reliability_changes) > 1 else 0
-            den_var = np.var(density_changes) if len(density_changes) > 1 else 0
+            if len(route) == 0:
+                return 0.0
             
-            return (rel_var + den_var) / 2
+            # Read from the metric history, no further TraCI calls
+            history = self.metrics.history
+            if history.counts("reliability", route).max() <= 1:
+                # No edge has been sampled in two steps yet, use the variability
+                # of the latest samples along the route instead
+                rel_var = self._nan_variance(history.latest("reliability", route))
+                den_var = self._nan_variance(history.latest("density", route))
+                return (rel_var + den_var) / 2
+            
+            variance = history.ewm_variance if self.dynamics_mode == "ewma" else history.variance
+            rel_var = variance("reliability", route).mean()
+            den_var = variance("density", route).mean()
+            speed_var = variance("speed", route).mean() / self.metrics.max_speed ** 2
+            
+            return float(rel_var + den_var + speed_var) / 3
         except Exception as e:
             self.logger.error(f"Error calculating network dynamics: {e}")
             return 0.0
 
+    @staticmethod
+    def _nan_variance(values: np.ndarray) -> float:
+        """Variance of the sampled values, 0 for fewer than two samples"""
+        values = values[~np.isnan(values)]
+        return float(np.var(values)) if len(values) > 1 else 0.0
+
     def _calculate_distance_to_destination(self, current_id: str, dest_id: str) -> float:
         """Calculate Euclidean distance to destination"""
         try:
@@ -346,22 +492,60 @@ class VANETACO:
             self.logger.error(f"Error calculating distance to destination: {e}")
             return float('inf')
 
-def main(net_file: str, num_vehicles: int, output_file: str):
-    """Main function to generate routes using VANET-ACO"""
+def build_rsu_coverage(net: sumolib.net.Net, ini_file: str, radio_config: str = None,
+                       obstacles: ObstacleIndex = None) -> Dict[str, float]:
+    """Best RSU power per edge (dBm) for the RSUs and transmit power of omnetpp.ini"""
+    alpha, frequency = (rsu_coverage.read_pathloss(radio_config) if radio_config
+                        else (rsu_coverage.DEFAULT_ALPHA, rsu_coverage.DEFAULT_FREQUENCY))
+    rsus = rsu_coverage.read_rsu_positions(ini_file)
+    raster = rsu_coverage.CoverageRaster(net.getBoundary(), rsus, alpha, frequency,
+                                         rsu_coverage.read_tx_power(ini_file), obstacles=obstacles)
+    logging.info(f"Computed coverage of {len(rsus)} RSUs on a {raster.shape[0]}x{raster.shape[1]} raster")
+    return raster.edge_table(net)
+
+def main(net_file: str, num_vehicles: int, output_file: str, use_net_cache: bool = True,
+         shared_routes: bool = False, alternatives_file: str = None, poly_file: str = None,
+         rsu_ini: str = None, radio_config: str = None):
+    """Main function to generate routes using VANET-ACO
+
+    With shared_routes, the routes are kept in a RouteTrie instead of a
+    RouteStore and identical routes are written once as named route
+    definitions which the vehicles reference. An alternatives_file written by
+    duarouter (e.g. nycmap.rou.alt.xml) seeds the pheromones. The buildings
+    of a poly_file (e.g. nycmap.poly.xml) shadow the RSSI between vehicles.
+    The RSUs of rsu_ini (omnetpp.ini) add their precomputed coverage to the
+    link reliability, using the path loss of radio_config (config.xml).
+    """
     try:
         # Initialize SUMO and load network
         if 'SUMO_HOME' not in os.environ:
             raise EnvironmentError("Please set SUMO_HOME environment variable")
             
-        traci.start(["sumo", "-n", net_file])
-        net = sumolib.net.readNet(net_file)
+        with span("traci.start", "traci"):
+            traci.start(["sumo", "-n", net_file])
+        # The compiled cache is rebuilt automatically when the network changes
+        with span("readNet", "io"):
+            net = netcache.readNet(net_file) if use_net_cache else sumolib.net.readNet(net_file)
         
         # Initialize VANET-ACO
-        aco = VANETACO(net)
+        obstacles = None
+        if poly_file:
+            with span("ObstacleIndex", "io"):
+                obstacles = ObstacleIndex.from_poly_file(poly_file)
+        rsu_coverage = None
+        if rsu_ini:
+            with span("CoverageRaster", "io"):
+                rsu_coverage = build_rsu_coverage(net, rsu_ini, radio_config, obstacles)
+        aco = VANETACO(net, obstacles=obstacles, rsu_coverage=rsu_coverage)
+        if alternatives_file:
+            aco.warm_start_pheromones(alternatives_file)
         logging.info("Initialized VANET-ACO algorithm")
         
-        # Generate routes for vehicles
-        routes = []
+        # Generate routes for vehicles, kept as one ragged int32 store (or as
+        # trie nodes for shared routes) and only turned into edge IDs when written
+        routes = RouteStore()
+        trie = RouteTrie() if shared_routes else None
+        nodes = []
         edges = net.getEdges()
         
         for i in range(num_vehicles):
@@ -376,25 +560,44 @@ def main(net_file: str, num_vehicles: int, output_file: str):
             quality = aco.calculate_route_quality(route)
             aco.update_pheromones(route, quality)
             
-            routes.append(route)
+            if trie is not None:
+                nodes.append(trie.insert(route))
+            else:
+                routes.append(route)
+            
+            # Every vehicle is one sampling round of the metric history
+            aco.metrics.next_step()
             
             if i % 10 == 0:
                 logging.info(f"Generated {i + 1}/{num_vehicles} routes")
         
         # Write routes to output file
-        with open(output_file, 'w') as f:
+        with span("write routes", "io", routes=num_vehicles), open(output_file, 'w') as f:
             f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
             f.write('<routes>\n')
             
-            for i, route in enumerate(routes):
-                route_str = ' '.join(route)
-                f.write(f'    <vehicle id="veh{i}" depart="0">\n')
-                f.write(f'        <route edges="{route_str}"/>\n')
-                f.write('    </vehicle>\n')
+            # Vehicles without a route (empty routes are not valid in SUMO) are left out
+            if trie is not None:
+                route_ids = trie.write_routes(f, aco.edge_index)
+                for i, node in enumerate(nodes):
+                    if node is not None:
+                        f.write(f'    <vehicle id="veh{i}" depart="0" route="{route_ids[node]}"/>\n')
+                logging.info(f"Shared routes: {trie.stats()}")
+            else:
+                for i, route in enumerate(routes):
+                    if len(route):
+                        f.write(f'    <vehicle id="veh{i}" depart="0">\n')
+                        routes.write_route(f, i, aco.edge_index)
+                        f.write('    </vehicle>\n')
             
             f.write('</routes>\n')
         
-        logging.info(f"Successfully wrote {num_vehicles} routes to {output_file}")
+        if trie is not None:
+            logging.info(f"Successfully wrote {trie.inserted} routes to {output_file} "
+                         f"({len(trie)} distinct)")
+        else:
+            logging.info(f"Successfully wrote {np.count_nonzero(routes.route_lengths())} routes to {output_file} "
+                         f"({routes.nbytes / 1024:.1f} KiB route store)")
         
     except Exception as e:
         logging.error(f"Error in main function: {e}")
@@ -403,12 +606,22 @@ def main(net_file: str, num_vehicles: int, output_file: str):
         traci.close()
 
 if __name__ == "__main__":
-    if len(sys.argv) != 4:
-        print("Usage: python script.py <net_file> <num_vehicles> <output_file>")
-        sys.exit(1)
-        
-    net_file = sys.argv[1]
-    num_vehicles = int(sys.argv[2])
-    output_file = sys.argv[3]
+    parser = argparse.ArgumentParser(description="Generate routes using VANET-ACO")
+    parser.add_argument("net_file")
+    parser.add_argument("num_vehicles", type=int)
+    parser.add_argument("output_file")
+    parser.add_argument("--shared-routes", action="store_true",
+                        help="write identical routes once as named route definitions")
+    parser.add_argument("--alternatives", metavar="FILE",
+                        help="seed the pheromones from duarouter route alternatives (e.g. nycmap.rou.alt.xml)")
+    parser.add_argument("--poly", metavar="FILE",
+                        help="shadow the RSSI by the buildings of a polygon file (e.g. nycmap.poly.xml)")
+    parser.add_argument("--rsu-ini", metavar="FILE",
+                        help="add the coverage of the RSUs of an omnetpp.ini to the link reliability")
+    parser.add_argument("--radio-config", metavar="FILE",
+                        help="path loss model of the RSU coverage (e.g. config.xml)")
+    args = parser.parse_args()
     
-    main(net_file, num_vehicles, output_file)
+    main(args.net_file, args.num_vehicles, args.output_file,
+         shared_routes=args.shared_routes, alternatives_file=args.alternatives, poly_file=args.poly,
+         rsu_ini=args.rsu_ini, radio_config=args.radio_config)
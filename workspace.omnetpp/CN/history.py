@@ -0,0 +1,91 @@
+"""Per-edge metric history in fixed-size ring buffers.
+
+Every metric (reliability, density, speed) keeps the last ``window``
+samples of each edge in one (metrics, edges, window) array. Recording a
+sample is O(1): it writes one slot and updates the exponentially weighted
+mean and variance of the edge, kept in flat arrays next to the ring heads
+and sample counts. Only the first sample of an edge in a
+simulation step is kept, so the window spans ``window`` steps and not
+``window`` metric calls, and repeated metric calls within a step cost one
+comparison. Statistics for many edges (e.g. all edges
+of a route) are read with one fancy index per array, without a loop over
+the edges.
+"""
+from typing import Sequence
+
+import numpy as np
+
+METRICS = ("reliability", "density", "speed")
+
+
+class EdgeHistory:
+    """Ring buffers of the last window samples of each metric per edge"""
+
+    def __init__(self, num_edges: int, window: int = 30, ewma_alpha: float = 0.2,
+                 metrics: Sequence[str] = METRICS):
+        self.window = window
+        self.ewma_alpha = ewma_alpha
+        self.metrics = {name: i for i, name in enumerate(metrics)}
+        self.num_edges = num_edges
+        shape = (len(self.metrics), num_edges)
+        self.samples = np.full(shape + (window,), np.nan)
+        # Scalar state per (metric, edge), flat with index metric * num_edges + edge
+        size = len(self.metrics) * num_edges
+        self._head = np.zeros(size, dtype=np.int64)       # slot of the latest sample
+        self._count = np.zeros(size, dtype=np.int64)
+        self._last_step = np.full(size, -1, dtype=np.int64)
+        self._mean = np.zeros(size)    # exponentially weighted mean
+        self._var = np.zeros(size)     # exponentially weighted variance
+        self.step = 0
+
+    def next_step(self):
+        """Start a new simulation step (or sampling round without a running simulation)"""
+        self.step += 1
+
+    def record(self, metric: str, edge: int, value: float):
+        i = self.metrics[metric] * self.num_edges + edge
+        last_step = self._last_step
+        if last_step[i] == self.step:
+            return
+        last_step[i] = self.step
+        count = int(self._count[i])
+        head = int(self._head[i])
+        if count > 0:
+            head = self._head[i] = (head + 1) % self.window
+        if count < self.window:
+            self._count[i] = count + 1
+        self.samples.flat[i * self.window + head] = value
+        if count == 0:
+            self._mean[i] = value
+        else:
+            a = self.ewma_alpha
+            mean = float(self._mean[i])
+            diff = value - mean
+            self._mean[i] = mean + a * diff
+            self._var[i] = (1 - a) * (float(self._var[i]) + a * diff * diff)
+
+    def _state(self, state: np.ndarray, metric: str, edges: np.ndarray) -> np.ndarray:
+        return state[self.metrics[metric] * self.num_edges + np.asarray(edges)]
+
+    def variance(self, metric: str, edges: np.ndarray) -> np.ndarray:
+        """Variance over the window of each edge, 0 for fewer than two samples"""
+        samples = self.samples[self.metrics[metric], edges]
+        counts = self.counts(metric, edges)
+        total = np.nansum(samples, axis=-1)
+        mean = total / np.maximum(counts, 1)
+        var = np.nansum((samples - mean[..., None]) ** 2, axis=-1) / np.maximum(counts, 1)
+        return np.where(counts > 1, var, 0.0)
+
+    def counts(self, metric: str, edges: np.ndarray) -> np.ndarray:
+        """Number of samples in the window of each edge"""
+        return self._state(self._count, metric, edges)
+
+    def ewma(self, metric: str, edges: np.ndarray) -> np.ndarray:
+        return self._state(self._mean, metric, edges)
+
+    def ewm_variance(self, metric: str, edges: np.ndarray) -> np.ndarray:
+        return self._state(self._var, metric, edges)
+
+    def latest(self, metric: str, edges: np.ndarray) -> np.ndarray:
+        """Latest sample of each edge, NaN without samples"""
+        return self.samples[self.metrics[metric], edges, self._state(self._head, metric, edges)]
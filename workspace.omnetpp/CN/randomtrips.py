@@ -1,3 +1,8 @@
+# Standalone copy of the original TraCI script with an inline CAMOACO skeleton
+# (select_next_node and calculate_path_cost are not implemented). The
+# maintained loop with per-vehicle colonies, budgeted rerouting and batched
+# route updates is CN/map/randomtrips.py; acoTrips.py in this directory is
+# VANET-ACO, not CAMOACO.
 import random
 from xml.etree import ElementTree as ET
 import traci
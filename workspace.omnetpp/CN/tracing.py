@@ -0,0 +1,157 @@
+"""
+Lightweight span tracing with Chrome trace-event export.
+
+Spans are recorded as (name, category, start, duration, thread, args)
+tuples in a bounded in-memory buffer and written at the end of a run as
+Chrome trace-event JSON, which can be opened in Perfetto
+(https://ui.perfetto.dev) or chrome://tracing. Nested spans on the same
+thread show up nested on its timeline, so the interplay of SUMO (TraCI
+calls) and the routing code becomes visible.
+
+Recording a span costs two perf_counter_ns calls and a deque append (one
+to three microseconds). While tracing is disabled, spans and traced
+functions only check a flag.
+
+Tracing is enabled by calling enable() or by setting the environment
+variable ACO_TRACE to the output file, which is then written at exit.
+Fine-grained categories (e.g. the per-edge "metrics" calls) can be left out
+by passing the categories to record, or by listing them comma separated in
+ACO_TRACE_CATEGORIES.
+"""
+
+from __future__ import print_function
+from __future__ import absolute_import
+import os
+import json
+import atexit
+import functools
+import threading
+from collections import deque
+from threading import get_ident
+from time import perf_counter_ns
+
+DEFAULT_CAPACITY = 1000000
+
+
+class _Span(object):
+    __slots__ = ("tracer", "name", "cat", "args", "start")
+
+    def __init__(self, tracer, name, cat, args):
+        self.tracer = tracer
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def __enter__(self):
+        self.start = perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer.record(self.name, self.cat, self.start, perf_counter_ns() - self.start, self.args)
+        return False
+
+
+class _NullSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Tracer(object):
+    """buffers the spans of all threads, only the latest capacity spans are kept"""
+
+    def __init__(self, enabled=False, capacity=DEFAULT_CAPACITY, categories=None):
+        self.enabled = enabled
+        self.categories = categories  # None records all categories
+        self.events = deque(maxlen=capacity)
+        self.recorded = 0
+        self.origin = perf_counter_ns()
+        self.thread_names = {}
+
+    def span(self, name, cat="python", **args):
+        """context manager recording a span, e.g. with span("simulationStep", "traci"): ..."""
+        if not self.enabled or (self.categories is not None and cat not in self.categories):
+            return _NULL_SPAN
+        return _Span(self, name, cat, args)
+
+    def record(self, name, cat, start, duration, args=None):
+        ident = get_ident()
+        if ident not in self.thread_names:
+            self.thread_names[ident] = threading.current_thread().name
+        self.events.append((name, cat, start, duration, ident, args))
+        self.recorded += 1
+
+    def clear(self):
+        self.events.clear()
+        self.recorded = 0
+
+    def to_chrome(self):
+        """the buffered spans as Chrome trace-event dict"""
+        pid = os.getpid()
+        threads = dict([(ident, i) for i, ident in enumerate(self.thread_names)])
+        events = [{"ph": "M", "name": "thread_name", "pid": pid, "tid": threads[ident], "args": {"name": name}}
+                  for ident, name in self.thread_names.items()]
+        for name, cat, start, duration, ident, args in self.events:
+            event = {"ph": "X", "name": name, "cat": cat, "pid": pid, "tid": threads[ident],
+                     "ts": (start - self.origin) / 1000.0, "dur": duration / 1000.0}
+            if args:
+                event["args"] = args
+            events.append(event)
+        return {"traceEvents": events, "displayTimeUnit": "ms",
+                "otherData": {"recorded": self.recorded, "dropped": self.recorded - len(self.events)}}
+
+    def export(self, fname):
+        with open(fname, 'w') as f:
+            json.dump(self.to_chrome(), f)
+
+
+tracer = Tracer()
+
+
+def enable(capacity=DEFAULT_CAPACITY, categories=None):
+    if capacity != tracer.events.maxlen:
+        tracer.events = deque(tracer.events, maxlen=capacity)
+    tracer.categories = None if categories is None else frozenset(categories)
+    tracer.enabled = True
+
+
+def disable():
+    tracer.enabled = False
+
+
+span = tracer.span
+
+
+def traced(name=None, cat="python"):
+    """decorator recording a span for every call of the function"""
+    def decorate(func):
+        label = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not tracer.enabled or (tracer.categories is not None and cat not in tracer.categories):
+                return func(*args, **kwargs)
+            start = perf_counter_ns()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                tracer.record(label, cat, start, perf_counter_ns() - start)
+        return wrapper
+    return decorate
+
+
+def export(fname):
+    tracer.export(fname)
+
+
+if os.environ.get("ACO_TRACE"):
+    enable(categories=os.environ["ACO_TRACE_CATEGORIES"].split(",") if os.environ.get("ACO_TRACE_CATEGORIES")
+           else None)
+    atexit.register(export, os.environ["ACO_TRACE"])